@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import time
+
+# measured before anything heavy is imported, see report_startup()
+IMPORT_START = time.perf_counter()
+
 from collections import OrderedDict
+import functools
 
 # from flask import Flask, render_template, send_from_directory, flash, session
 from flask import (
@@ -14,27 +20,60 @@ from flask import (
     redirect,
     request,
     jsonify,
+    get_flashed_messages,
+    make_response,
+    session as flask_session,
+    g,
+    Response,
+    stream_with_context,
+    abort,
+    has_request_context,
 )
+from flask.signals import before_render_template, template_rendered
+import click
 import flask_bootstrap
 from flask_sqlalchemy import SQLAlchemy
 from flask_session import Session
 from flask_wtf import FlaskForm, CSRFProtect
-from wtforms.fields import *
+from flask_wtf.csrf import generate_csrf
+from wtforms.fields import (
+    BooleanField,
+    EmailField,
+    PasswordField,
+    SelectMultipleField,
+    StringField,
+    SubmitField,
+)
 from wtforms.widgets import html_params
 from wtforms.validators import DataRequired, Length
-from sqlalchemy import ForeignKey, UniqueConstraint, func
+from sqlalchemy import (
+    ForeignKey,
+    Index,
+    Integer,
+    UniqueConstraint,
+    cast,
+    func,
+    insert,
+    inspect,
+    text,
+    update,
+)
 from sqlalchemy.exc import IntegrityError, PendingRollbackError
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.orm import DeclarativeBase, aliased
 from sqlalchemy.orm import Mapped, mapped_column
 from cachelib.file import FileSystemCache
-from functools import lru_cache
+from markupsafe import Markup, escape
 import os
 import json
-import base64
-import pprint
 import datetime
-import smtplib
-import ssl
+import hashlib
+import secrets
+
+from matching import CANCELLED, CONFIRMED, OBJECTIVES, TopicState
+import metrics
+import ics
+
+IMPORT_TIME = time.perf_counter() - IMPORT_START
 
 # from enum import Enum
 # from markupsafe import Markup
@@ -43,12 +82,47 @@ import ssl
 # from sqlalchemy import ForeignKey, UniqueConstraint
 
 
+CSRF_PLACEHOLDER = "__CHATMATCH_CSRF_TOKEN__"
+
+DEFAULT_TOPICS = [
+    {
+        "topic": "Default",
+        "description": "This is the default topic. Usually not used.",
+        "hidden": True,
+    },
+    {"topic": "Poly with (planned) kids"},
+    {"topic": "Jealousy"},
+    {"topic": "Transitioning to Relationship Anarchy"},
+    {"topic": "Sex, safety and transparency"},
+    {"topic": "Organizing calendars and time limitations"},
+    {"topic": "Cohabitation"},
+]
+
+# default slots (hardcoded for 39C3), "end" is when the last slot ends
+DEFAULT_SCHEDULE = {
+    "duration": 1800,
+    "days": [
+        {"date": "2025-12-27", "start": "13:00", "end": "19:30"},
+        {"date": "2025-12-28", "start": "11:00", "end": "19:00"},
+        {"date": "2025-12-29", "start": "11:00", "end": "19:00"},
+        {"date": "2025-12-30", "start": "11:00", "end": "15:00"},
+    ],
+}
+
+
 def get_config(key):
     global app
     return app.config[key]
 
 
 def list_themes():
+    # scan the bootswatch themes once instead of on every render
+    if "CHATMATCH_THEMES" not in app.config:
+        app.config["CHATMATCH_THEMES"] = load_themes()
+    return get_config("CHATMATCH_THEMES")
+
+
+def load_themes():
     base = os.path.join(
         os.path.dirname(flask_bootstrap.__file__),
         "static",
@@ -89,6 +163,9 @@ class User(ChatMatch):
     __table_args__ = (
         UniqueConstraint("email"),
         UniqueConstraint("nickname"),
+        # self-service links and calendar feeds look users up by it, an index
+        # so that seed adds it to existing databases
+        Index("uq_user_table_magic", "magic", unique=True),
     )
 
 
@@ -120,8 +197,13 @@ class Slot(ChatMatch):
     create_time: Mapped[int]
     editor: Mapped[int | None] = mapped_column(ForeignKey("user_table.id"))
     edit_time: Mapped[int | None]
+    # bumped whenever seats of the slot are handed out, see lock_slot()
+    version: Mapped[int] = mapped_column(default=0, server_default="0")
 
-    __table_args__ = (UniqueConstraint("start_time", "topic"),)
+    __table_args__ = (
+        UniqueConstraint("start_time", "topic"),
+        Index("ix_slot_topic_start_time", "topic", "start_time"),
+    )
 
 
 class Match(ChatMatch):
@@ -136,7 +218,51 @@ class Match(ChatMatch):
     confirm_time: Mapped[int | None]
     cancel_time: Mapped[int | None]
 
-    __table_args__ = (UniqueConstraint("slot", "user"),)
+    __table_args__ = (
+        UniqueConstraint("slot", "user"),
+        Index("ix_match_slot_cancel_create", "slot", "cancel_time", "create_time"),
+        Index("ix_match_user_slot", "user", "slot"),
+    )
+
+
+class Mail(ChatMatch):
+    __tablename__ = "mail_table"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    recipient: Mapped[str]
+    message: Mapped[str]
+    create_time: Mapped[int]
+    attempts: Mapped[int]
+    retry_time: Mapped[int | None]
+    send_time: Mapped[int | None]
+    error: Mapped[str | None]
+
+    __table_args__ = (Index("ix_mail_send_time", "send_time", "id"),)
+
+
+class Job(ChatMatch):
+    __tablename__ = "job_table"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    # "add", "uncancel", "cancel", "recalc" or "freed" (the user gave up a
+    # seat at the same time, see index())
+    kind: Mapped[str]
+    # set on "recalc" jobs of the global mode, see TopicState.assign()
+    objective: Mapped[str | None]
+    topic: Mapped[int] = mapped_column(ForeignKey("topic_table.id"))
+    slot: Mapped[int | None] = mapped_column(ForeignKey("slot_table.id"))
+    match: Mapped[int | None] = mapped_column(ForeignKey("match_table.id"))
+    user: Mapped[int | None] = mapped_column(ForeignKey("user_table.id"))
+    create_time: Mapped[int]
+    done_time: Mapped[int | None]
+    error: Mapped[str | None]
+    # JSON statistics of the recalculation, see recalc_topic()
+    result: Mapped[str | None]
+
+    __table_args__ = (
+        Index("ix_job_done_time", "done_time", "id"),
+        Index("ix_job_topic_id", "topic", "id"),
+    )
 
 
 class RegisterButtonForm(FlaskForm):
@@ -154,9 +280,13 @@ class HelloForm(FlaskForm):
     submit = SubmitField()
 
 
-@lru_cache(maxsize=16)
 def fetch_topics():
     global db
+    cache = get_config("CHATMATCH_CACHE")
+    choices = cache.get("topics")
+    if choices is not None:
+        return choices
+
     topics = db.session.execute(
         db.select(Topic).where(Topic.hidden == False).order_by(Topic.id)
     )
@@ -165,17 +295,28 @@ def fetch_topics():
     for row in topics:
         choices.append((row.Topic.id, row.Topic.topic))
 
+    cache.set("topics", choices, timeout=get_config("CHATMATCH_CACHE_TTL"))
     return choices
 
 
-@lru_cache(maxsize=16)
 def fetch_slots(topic_id):
+    key = "slots-%d" % topic_id
+    cache = get_config("CHATMATCH_CACHE")
+    choices = cache.get(key)
+    if choices is not None:
+        return choices
+
     # fetch Slots and Topic
     slot_rows = db.session.execute(
-        db.select(Slot, Topic).where(Slot.topic == Topic.id, Topic.id == topic_id)
+        db.select(Slot, Topic)
+        .where(Slot.topic == Topic.id)
+        .where(Topic.id == topic_id)
+        .order_by(Slot.start_time)
     )
 
     # collect data for calendar view
+    now = datetime.datetime.now()
+    next_start = None
     days = dict()
     slots = dict()
     topic = Topic()
@@ -183,7 +324,6 @@ def fetch_slots(topic_id):
         # this will override the higher scope variable all of the time
         topic = row.Topic
 
-        now = datetime.datetime.now()
         start_time = datetime.datetime.fromtimestamp(row.Slot.start_time)
         end_time = start_time + datetime.timedelta(seconds=row.Slot.duration)
         day = start_time.strftime("%Y%m%d")
@@ -197,6 +337,8 @@ def fetch_slots(topic_id):
             slots[slot] += 1
 
         days[day][slot] = True if start_time > now else False
+        if start_time > now and (next_start is None or start_time < next_start):
+            next_start = start_time
 
     # pivot data into calendar structure
     calendar = []
@@ -222,214 +364,440 @@ def fetch_slots(topic_id):
         del entry["slot"]
         choices.append((entry, slot))
 
+    # expire when the next slot starts, so it gets disabled in time
+    timeout = get_config("CHATMATCH_CACHE_TTL")
+    if next_start is not None:
+        timeout = max(1, min(timeout, int((next_start - now).total_seconds())))
+    cache.set(key, choices, timeout=timeout)
     return choices
 
 
-def index():
-    global db
+def fetch_slot_keys(topic_id):
+    """Return ({form key: slot id}, {slot id: form key}) for a topic."""
+    cache = get_config("CHATMATCH_CACHE")
+    keys = cache.get("slotkeys-%d" % topic_id)
+    if keys is not None:
+        return keys
+
+    slotkeys = dict()
+    slotnames = dict()
+    slots = db.session.execute(topic_slots_query(topic_id))
+    for slot_id, start_time, duration in slots:
+        slotstart = datetime.datetime.fromtimestamp(start_time)
+        slotend = slotstart + datetime.timedelta(seconds=duration)
+        # as rendered by chatmatch_matrix_widget()
+        slotname = "slots-%d-%s-%s" % (
+            topic_id,
+            slotstart.strftime("%Y%m%d-%H:%M"),
+            slotend.strftime("%H:%M"),
+        )
+        slotkeys[slotname] = slot_id
+        slotnames[slot_id] = slotname
 
-    def chatmatch_calendar_widget(field, ul_class="", **kwargs):
-        kwargs.setdefault("type", "checkbox")
-        field_id = kwargs.pop("id", field.id)
-        # html = ['<ul %s>' % html_params(id=field_id, class_=ul_class)]
-        html = [
-            '<div class="tables-responsive-sm">\n<table class="table table-striped" %s>\n'
-            % html_params(id=field_id, class_=ul_class)
-        ]
-        titles = None
-        body = None
-        for values, label, checked, render_kw in field.iter_choices():
-            if not titles and label == "titles":
-                titles = values
-                html.append('<thead class="thead-dark">\n <tr>\n')
-                for title in titles:
-                    html.append('  <th scope="col">%s</th>\n' % title[1])
-                html.append(" </tr>\n</thead>")
-                continue
-            if not body:
-                body = True
-                html.append('<tbody class="table-group-divider">\n')
-
-            html.append(" <tr>\n")
-            for idx, title in enumerate(titles):
-                if idx == 0:
-                    html.append("  <td>%s</td>\n" % label)
-                else:
-                    if title[0] in values.keys():
-                        choice_id = "%s-%s-%s" % (field_id, title[0], label)
-                        if "class" in kwargs:
-                            del kwargs["class"]
-                        if not values[title[0]]:
-                            kwargs["disabled"] = "disabled"
-                        else:
-                            if "disabled" in kwargs:
-                                del kwargs["disabled"]
-                        options = dict(kwargs, name=choice_id, id=choice_id)
-                        html.append(
-                            "  <td><input %s /></td>\n" % html_params(**options)
-                        )
-                    else:
-                        html.append("  <td></td>\n")
-
-            # for idx,value in values.items():
-            #  pprint.pp('value')
-            #  pprint.pp(value)
-            #  choice_id = '%s-%s-%s' % (field_id, label, value)
-            #  options = dict(kwargs, name=field.name, value=value, id=choice_id)
-            #  if checked:
-            #    options['checked'] = 'checked'
-            #  html.append('<td> %d %s </td>' % (idx,html_params(**options)))
-            html.append(" </tr>\n")
-        if body:
-            html.append("</tbody>\n")
-        html.append("</table>\n</div>")
-        return "".join(html)
-
-    class MainForm(FlaskForm):
-        """Our main form."""
-
-        nickname = StringField(description="Your nickname. Will be visible to others")
-        email = EmailField(
-            description="Your email address. Will be used to send you notifications, and nothing else"
+    keys = (slotkeys, slotnames)
+    cache.set("slotkeys-%d" % topic_id, keys, timeout=get_config("CHATMATCH_CACHE_TTL"))
+    return keys
+
+
+def invalidate_topics():
+    get_config("CHATMATCH_CACHE").delete("topics")
+
+
+def invalidate_slots(topic_id):
+    get_config("CHATMATCH_CACHE").delete_many(
+        "slots-%d" % topic_id, "slotkeys-%d" % topic_id
+    )
+
+
+def chatmatch_matrix_widget(field, **kwargs):
+    """One calendar grid per topic, field.choices are (topic id, topic,
+    fetch_slots() of the topic). Checkbox names carry the topic id."""
+    field_id = kwargs.pop("id", field.id)
+    html = []
+    for topic_id, topic, choices in field.choices:
+        html.append(
+            '<div class="chatmatch-topic" data-topic="%d">\n<h5>%s</h5>\n'
+            % (topic_id, escape(topic))
+        )
+        html.append(
+            chatmatch_calendar_widget(
+                field, choices=choices, id="%s-%d" % (field_id, topic_id), **kwargs
+            )
         )
+        html.append("</div>\n")
+    return "".join(html)
+
+
+def chatmatch_calendar_widget(field, ul_class="", choices=None, **kwargs):
+    kwargs.setdefault("type", "checkbox")
+    field_id = kwargs.pop("id", field.id)
+    if choices is None:
+        choices = field.choices
+    # html = ['<ul %s>' % html_params(id=field_id, class_=ul_class)]
+    html = [
+        '<div class="tables-responsive-sm">\n<table class="table table-striped" %s>\n'
+        % html_params(id=field_id, class_=ul_class)
+    ]
+    titles = None
+    body = None
+    for values, label in choices:
+        if not titles and label == "titles":
+            titles = values
+            html.append('<thead class="thead-dark">\n <tr>\n')
+            for title in titles:
+                html.append('  <th scope="col">%s</th>\n' % title[1])
+            html.append(" </tr>\n</thead>")
+            continue
+        if not body:
+            body = True
+            html.append('<tbody class="table-group-divider">\n')
+
+        html.append(" <tr>\n")
+        for idx, title in enumerate(titles):
+            if idx == 0:
+                html.append("  <td>%s</td>\n" % label)
+            else:
+                if title[0] in values.keys():
+                    choice_id = "%s-%s-%s" % (field_id, title[0], label)
+                    if "class" in kwargs:
+                        del kwargs["class"]
+                    if not values[title[0]]:
+                        kwargs["disabled"] = "disabled"
+                    else:
+                        if "disabled" in kwargs:
+                            del kwargs["disabled"]
+                    options = dict(kwargs, name=choice_id, id=choice_id)
+                    html.append("  <td><input %s /></td>\n" % html_params(**options))
+                else:
+                    html.append("  <td></td>\n")
+
+        # for idx,value in values.items():
+        #  pprint.pp('value')
+        #  pprint.pp(value)
+        #  choice_id = '%s-%s-%s' % (field_id, label, value)
+        #  options = dict(kwargs, name=field.name, value=value, id=choice_id)
+        #  if checked:
+        #    options['checked'] = 'checked'
+        #  html.append('<td> %d %s </td>' % (idx,html_params(**options)))
+        html.append(" </tr>\n")
+    if body:
+        html.append("</tbody>\n")
+    html.append("</table>\n</div>")
+    return "".join(html)
+
+
+class MainForm(FlaskForm):
+    """Our main form."""
+
+    nickname = StringField(description="Your nickname. Will be visible to others")
+    email = EmailField(
+        description="Your email address. Will be used to send you notifications, and nothing else"
+    )
 
-        # Topics
-        topic = SelectField(choices=fetch_topics())
+    # Topics, choices are filled in per request
+    topic = SelectMultipleField(
+        choices=[],
+        coerce=int,
+        description="Pick one or more topics, then tick your time slots for each of them below",
+    )
+
+    # Slots, a grid per topic, see chatmatch_matrix_widget()
+    slots = SelectMultipleField(
+        choices=[],
+        widget=chatmatch_matrix_widget,
+        validate_choice=False,
+    )
 
-        # Slots
-        slots = SelectMultipleField(
-            # FIXME slots are loaded from first, hidden topic
-            choices=fetch_slots(1),
-            widget=chatmatch_calendar_widget,
+    submit = SubmitField()
+
+
+def load_user(nickname, email, now):
+    """Return the user's (id, nickname, email, magic), creating them if
+    needed, or None if nickname or email belong to somebody else.
+
+    Doesn't commit, the caller commits with its own changes.
+    """
+    user = recent_users.get((nickname, email))
+    if user is not None:
+        recent_users.move_to_end((nickname, email))
+        db.session.execute(
+            update(User)
+            .where(User.id == user.id)
+            .values(lastuse_time=now)
+            .execution_options(synchronize_session=False)
         )
+        return user
 
-        submit = SubmitField()
+    statement = upsert_user(nickname, email, now)
+    try:
+        if statement is not None:
+            user = db.session.execute(statement).one_or_none()
+        else:
+            user = fallback_upsert_user(nickname, email, now)
+    except IntegrityError:
+        # the email address belongs to another nickname
+        db.session.rollback()
+        return None
+    if user is None:
+        # the nickname belongs to another email address
+        db.session.rollback()
+        return None
+    if user.lastuse_time is None:
+        print("✅ ADD USER %s" % nickname)
+
+    # older versions stored raw bytes, which can't go into links
+    if not isinstance(user.magic, str):
+        user = db.session.execute(
+            update(User)
+            .where(User.id == user.id)
+            .values(magic=secrets.token_urlsafe(32))
+            .returning(
+                User.id, User.nickname, User.email, User.magic, User.lastuse_time
+            )
+            .execution_options(synchronize_session=False)
+        ).one()
+    return user
+
+
+def upsert_user(nickname, email, now):
+    # INSERT ... ON CONFLICT returning the row, where the dialect has it
+    dialect = db.engine.dialect.name
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    elif dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        return None
+
+    statement = dialect_insert(User).values(
+        nickname=nickname,
+        email=email,
+        magic=secrets.token_urlsafe(32),
+        create_time=now,
+    )
+    # only touches the row if the email matches, otherwise nothing returns
+    return statement.on_conflict_do_update(
+        index_elements=[User.nickname],
+        set_={"lastuse_time": now},
+        where=User.email == statement.excluded.email,
+    ).returning(User.id, User.nickname, User.email, User.magic, User.lastuse_time)
+
+
+def fallback_upsert_user(nickname, email, now):
+    columns = (User.id, User.nickname, User.email, User.magic, User.lastuse_time)
+    user = db.session.execute(
+        db.select(*columns).where(User.nickname == nickname)
+    ).one_or_none()
+    if user is None:
+        return db.session.execute(
+            insert(User)
+            .values(
+                nickname=nickname,
+                email=email,
+                magic=secrets.token_urlsafe(32),
+                create_time=now,
+            )
+            .returning(*columns)
+        ).one()
+    if user.email != email:
+        return None
+    db.session.execute(
+        update(User)
+        .where(User.id == user.id)
+        .values(lastuse_time=now)
+        .execution_options(synchronize_session=False)
+    )
+    return user
+
+
+def remember_user(nickname, email, user):
+    # users never change nickname or email, so this can't go stale
+    recent_users[(nickname, email)] = user
+    recent_users.move_to_end((nickname, email))
+    while len(recent_users) > get_config("CHATMATCH_USER_CACHE"):
+        recent_users.popitem(last=False)
+
+
+def index():
+    global db
 
     form = MainForm()
+    form.topic.choices = fetch_topics()
+    form.slots.choices = [
+        (topic_id, topic, fetch_slots(topic_id))
+        for topic_id, topic in form.topic.choices
+    ]
     if form.validate_on_submit():
         formdict = request.form.to_dict()
-        # try to load user
-        users = db.session.execute(
-            db.select(User)
-            .where(User.nickname == formdict["nickname"])
-            .where(User.email == formdict["email"])
-        ).all()
-        # create user if it doesn't exist
-        if not len(users):
-            try:
-                user = User()
-                user.nickname = formdict["nickname"]
-                user.email = formdict["email"]
-                user.magic = base64.b64encode(os.urandom(32))
-                user.create_time = int(datetime.datetime.now().timestamp())
-                db.session.add(user)
-                db.session.commit()
-            except IntegrityError:
-                print("❎ DUPLICATE USER %s" % formdict["nickname"])
-                flash(
-                    "Either the nickname or the email address exist already - and don't match! Sorry.",
-                    "danger",
-                )
-                return redirect(url_for("index"))
-            print("✅ ADD USER %s" % formdict["nickname"])
-
-        # load users again
-        users = db.session.execute(
-            db.select(User)
-            .where(User.nickname == formdict["nickname"])
-            .where(User.email == formdict["email"])
-        ).all()
-        user = users[0].User
-        if not len(users):
-            print("❎ COULD NOT (RE)LOAD USER %s" % formdict["nickname"])
+        # find or create the user, in the transaction of the match changes
+        now = int(datetime.datetime.now().timestamp())
+        user = load_user(formdict["nickname"], formdict["email"], now)
+        if user is None:
+            print("❎ DUPLICATE USER %s" % formdict["nickname"])
             flash(
-                "Loading user failed for some odd reason. Sorry.",
+                "Either the nickname or the email address exist already - and don't match! Sorry.",
                 "danger",
             )
             return redirect(url_for("index"))
 
-        # try to load topic
-        topics = db.session.execute(
-            db.select(Topic).where(Topic.id == int(formdict["topic"]))
-        ).all()
-        if len(topics) != 1:
+        # try to load the picked topics
+        if not form.topic.data:
+            flash("Please pick at least one topic.", "warning")
+            return redirect(url_for("index"))
+        topics = (
+            db.session.execute(
+                db.select(Topic).where(Topic.id.in_(form.topic.data)).order_by(Topic.id)
+            )
+            .scalars()
+            .all()
+        )
+        if len(topics) != len(set(form.topic.data)):
             flash(
                 "Something went wrong finding the topic! Sorry.",
                 "danger",
             )
             return redirect(url_for("index"))
-        topic = topics[0].Topic
 
         # try to load user's slots
-        matches = db.session.execute(
-            db.select(Match).where(Match.user == user.id)
-        ).all()
+        matches = db.session.execute(user_slots_query(user.id)).all()
         matchslots = dict()
         for row in matches:
-            matchslots[row.Match.slot] = row.Match
-        if app.debug and 0:
-            pprint.pp("matchslots")
-            pprint.pp(matchslots)
-
-        # try to load all slots
-        slots = db.session.execute(db.select(Slot).where(Slot.topic == topic.id)).all()
-
-        # Do we need to recalc the Matches?
-        recalc = False
-        # check all slots
+            matchslots[row.slot] = row
+
+        # map the submitted form keys to slots, each key only through the grid
+        # of its own topic
+        submitted = set()
+        slotnames = dict()
+        slottopics = dict()
+        for topic in topics:
+            slotkeys, names = fetch_slot_keys(topic.id)
+            slotnames.update(names)
+            slottopics.update(dict.fromkeys(names, topic.id))
+            for key in formdict:
+                if key in slotkeys:
+                    submitted.add(slotkeys[key])
+
+        # diff the submitted slots against the user's matches
+        add = []
+        uncancel = []
+        cancel = []
         if app.debug:
+            import pprint
+
             print("FORMDICT")
             pprint.pp(formdict)
-        for row in slots:
-            slotstart = datetime.datetime.fromtimestamp(row.Slot.start_time)
-            slotend = slotstart + datetime.timedelta(seconds=row.Slot.duration)
-            slotname = "slots-%s-%s" % (
-                slotstart.strftime("%Y%m%d-%H:%M"),
-                slotend.strftime("%H:%M"),
-            )
-
-            if slotname in formdict:
-                if row.Slot.id in matchslots.keys():
-                    if not matchslots[row.Slot.id].cancel_time:
-                        print("✅ EXISTING MATCH %s" % slotname)
-                    else:
-                        print("✅ UNCANCEL MATCH %s" % slotname)
-                        db.session.query(Match).filter(
-                            Match.id == matchslots[row.Slot.id].id
-                        ).update(
-                            {
-                                "confirmed": False,
-                                "confirm_time": None,
-                                "edit_time": int(datetime.datetime.now().timestamp()),
-                                "cancel_time": None,
-                            }
-                        )
-                        recalc = True
-                else:
-                    print("✅ ADD MATCH %s" % slotname)
-                    match = Match()
-                    match.slot = row.Slot.id
-                    match.user = user.id
-                    match.create_time = int(datetime.datetime.now().timestamp())
-                    match.confirmed = False
-                    match.cancel_time = None
-                    db.session.add(match)
-                    recalc = True
-
-            elif row.Slot.id in matchslots.keys():
-                print("✅ CANCEL MATCH %s" % slotname)
-                db.session.query(Match).filter(
-                    Match.id == matchslots[row.Slot.id].id
-                ).update(
+        for slot_id in sorted(submitted):
+            match = matchslots.get(slot_id)
+            if match is None:
+                print("✅ ADD MATCH %s" % slotnames[slot_id])
+                add.append(slot_id)
+            elif match.cancel_time:
+                print("✅ UNCANCEL MATCH %s" % slotnames[slot_id])
+                uncancel.append(match)
+            else:
+                print("✅ EXISTING MATCH %s" % slotnames[slot_id])
+        for slot_id, match in matchslots.items():
+            if (
+                slot_id in slotnames
+                and slot_id not in submitted
+                and not match.cancel_time
+            ):
+                print("✅ CANCEL MATCH %s" % slotnames[slot_id])
+                cancel.append(match)
+
+        # apply the diff with at most three statements in one transaction
+        added = []
+        if add:
+            added = db.session.execute(
+                insert(Match).returning(Match.slot, Match.id),
+                [
                     {
+                        "slot": slot_id,
+                        "user": user.id,
+                        "create_time": now,
                         "confirmed": False,
-                        "edit_time": int(datetime.datetime.now().timestamp()),
-                        "cancel_time": int(datetime.datetime.now().timestamp()),
+                        "cancel_time": None,
                     }
+                    for slot_id in add
+                ],
+            ).all()
+        if uncancel:
+            db.session.execute(
+                update(Match)
+                .where(Match.id.in_([match.id for match in uncancel]))
+                .values(
+                    confirmed=False, confirm_time=None, edit_time=now, cancel_time=None
                 )
-                recalc = True
+                .execution_options(synchronize_session=False)
+            )
+        if cancel:
+            db.session.execute(
+                update(Match)
+                .where(Match.id.in_([match.id for match in cancel]))
+                .values(confirmed=False, edit_time=now, cancel_time=now)
+                .execution_options(synchronize_session=False)
+            )
 
+        # waiting matches the user was kept out of while confirmed for a group
+        # at the same time, in any topic, can be confirmed again now
+        left = [match.slot for match in cancel if match.confirmed]
+        freed = []
+        if left:
+            freed = db.session.execute(freed_query(user.id, left)).all()
+
+        # record the changes as matching jobs in the same transaction
+        events = (
+            [
+                ("add", slottopics[slot_id], slot_id, match_id)
+                for slot_id, match_id in added
+            ]
+            + [
+                ("uncancel", slottopics[match.slot], match.slot, match.id)
+                for match in uncancel
+            ]
+            + [
+                ("cancel", slottopics[match.slot], match.slot, match.id)
+                for match in cancel
+            ]
+            + [
+                ("freed", topic_id, slot_id, match_id)
+                for match_id, slot_id, topic_id in freed
+            ]
+        )
+        jobs = []
+        if events:
+            jobs = (
+                db.session.execute(
+                    insert(Job).returning(Job.id),
+                    [
+                        {
+                            "kind": kind,
+                            "topic": topic_id,
+                            "slot": slot_id,
+                            "match": match_id,
+                            "user": user.id,
+                            "create_time": now,
+                        }
+                        for kind, topic_id, slot_id, match_id in events
+                    ],
+                )
+                .scalars()
+                .all()
+            )
         db.session.commit()
+        remember_user(formdict["nickname"], formdict["email"], user)
+
+        # the user's calendar changed, and so did those of groups they left
+        if left:
+            build_slot_events(left)
+        invalidate_calendars(
+            [user.id]
+            + [
+                user_id
+                for members in group_members(left).values()
+                for user_id, nickname in members
+            ]
+        )
 
         # class Slot(ChatMatch):
         #     __tablename__ = "slot_table"
@@ -458,31 +826,438 @@ def index():
             "Form submitted! Thanks! You will get a confirmation email. Feel free to submit another form!",
             "success",
         )
-        send_topic_mail(user, topic)
+        flash(
+            Markup(
+                'Your personal status page, with a calendar to subscribe to: <a href="%s">%s</a>'
+            )
+            % ((url_for("status", token=user.magic, _external=True),) * 2),
+            "info",
+        )
+        send_topic_mail(user, topics)
 
-        if recalc:
-            recalc_topic(topics[0].Topic.id)
+        # otherwise the matcher worker picks the jobs up
+        if jobs and get_config("CHATMATCH_MATCHER") == "inline":
+            run_jobs(load_jobs(Job.id.in_(jobs)))
 
         return redirect(url_for("index"))
 
-    return render_template("index.html", form=form)
+    return render_index(form)
+
+
+def render_index(form):
+    # flashed messages and validation errors make the page personal
+    if request.method != "GET" or get_flashed_messages():
+        return render_template("index.html", form=form)
+
+    # the page only changes with the form choices (including the flags of
+    # past slots) and the site configuration
+    version = hashlib.sha1(
+        repr(
+            (
+                form.topic.choices,
+                form.slots.choices,
+                get_config("CHATMATCH_TITLE"),
+                get_config("CHATMATCH_DESCRIPTION"),
+                get_config("BOOTSTRAP_BOOTSWATCH_THEME"),
+            )
+        ).encode()
+    ).hexdigest()[:16]
+
+    # render once per version with a placeholder instead of the CSRF token
+    cache = get_config("CHATMATCH_CACHE")
+    page = cache.get("index-%s" % version)
+    token = generate_csrf() if get_config("WTF_CSRF_ENABLED") else None
+    if page is None:
+        html = render_template("index.html", form=form)
+        if token:
+            html = html.replace(token, CSRF_PLACEHOLDER)
+        page = (html, int(datetime.datetime.now().timestamp()))
+        cache.set("index-%s" % version, page, timeout=get_config("CHATMATCH_CACHE_TTL"))
+    html, built = page
+
+    response = make_response(html.replace(CSRF_PLACEHOLDER, token) if token else html)
+
+    # the embedded token is bound to the session and only valid for a while,
+    # so the ETag changes with both
+    etag = version
+    if token:
+        bucket = 0
+        if get_config("WTF_CSRF_TIME_LIMIT"):
+            bucket = int(time.time()) // (get_config("WTF_CSRF_TIME_LIMIT") // 2)
+        raw = flask_session.get(get_config("WTF_CSRF_FIELD_NAME"), "")
+        etag += "-" + hashlib.sha1(("%s-%d" % (raw, bucket)).encode()).hexdigest()[:16]
+    response.set_etag(etag)
+    response.last_modified = built
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    return response.make_conditional(request)
+
+
+def load_user_by_token(token):
+    user = db.session.execute(user_by_token_query(token)).scalar_one_or_none()
+    if user is None:
+        abort(404)
+    return user
+
+
+def user_by_token_query(token):
+    return db.select(User).where(User.magic == token)
+
+
+def user_slots_query(user_id):
+    return db.select(Match.id, Match.slot, Match.confirmed, Match.cancel_time).where(
+        Match.user == user_id
+    )
+
+
+def user_matches(user_id):
+    return db.session.execute(user_matches_query(user_id)).all()
+
+
+def user_matches_query(user_id):
+    return (
+        db.select(
+            Match.id,
+            Match.slot,
+            Match.confirmed,
+            Match.cancel_time,
+            Slot.start_time,
+            Slot.duration,
+            Topic.topic,
+        )
+        .join(Slot, Slot.id == Match.slot)
+        .join(Topic, Topic.id == Slot.topic)
+        .where(Match.user == user_id)
+        .order_by(Slot.start_time, Topic.topic)
+    )
+
+
+def group_members(slot_ids):
+    """{slot id: [(user id, nickname)]} of the confirmed groups of slots."""
+    groups = dict()
+    if not slot_ids:
+        return groups
+    rows = db.session.execute(group_members_query(slot_ids))
+    for slot_id, user_id, nickname in rows:
+        groups.setdefault(slot_id, []).append((user_id, nickname))
+    return groups
+
+
+def group_members_query(slot_ids):
+    return (
+        db.select(Match.slot, User.id, User.nickname)
+        .join(User, User.id == Match.user)
+        .where(Match.slot.in_(slot_ids))
+        .where(Match.confirmed == True)
+        .where(Match.cancel_time == None)
+        .order_by(User.nickname)
+    )
+
+
+def status(token):
+    user = load_user_by_token(token)
+    matches = user_matches(user.id)
+    groups = group_members(
+        [match.slot for match in matches if match.confirmed and not match.cancel_time]
+    )
+
+    now = int(datetime.datetime.now().timestamp())
+    entries = []
+    for match in matches:
+        start_time = datetime.datetime.fromtimestamp(match.start_time)
+        end_time = start_time + datetime.timedelta(seconds=match.duration)
+        if match.cancel_time:
+            state = "cancelled"
+        elif match.confirmed:
+            state = "confirmed"
+        elif match.start_time <= now:
+            state = "past"
+        else:
+            state = "waiting"
+        entries.append(
+            {
+                "topic": match.topic,
+                "time": "%s-%s"
+                % (start_time.strftime("%d.%m.%Y %H:%M"), end_time.strftime("%H:%M")),
+                "state": state,
+                "group": (
+                    [nickname for user_id, nickname in groups.get(match.slot, [])]
+                    if state == "confirmed"
+                    else []
+                ),
+            }
+        )
+
+    return render_template(
+        "status.html",
+        user=user,
+        entries=entries,
+        calendar_url=url_for("user_calendar", token=token, _external=True),
+    )
+
+
+def user_calendar(token):
+    user = load_user_by_token(token)
+
+    # calendar apps poll this, so the body is only built when it changed
+    cache = get_config("CHATMATCH_FEED_CACHE")
+    feed = cache.get("ics-%d" % user.id)
+    if feed is None:
+        body = build_calendar(user)
+        feed = (
+            body,
+            hashlib.sha1(body.encode()).hexdigest()[:16],
+            int(datetime.datetime.now().timestamp()),
+        )
+        cache.set("ics-%d" % user.id, feed, timeout=get_config("CHATMATCH_CACHE_TTL"))
+    body, etag, built = feed
+
+    response = make_response(body)
+    response.mimetype = "text/calendar"
+    response.set_etag(etag)
+    response.last_modified = built
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def build_calendar(user):
+    # put together from the cached events of the user's groups
+    slot_ids = db.session.execute(calendar_slots_query(user.id)).scalars().all()
+    return ics.calendar(slot_events(slot_ids), name=get_config("CHATMATCH_NAME"))
+
+
+def calendar_slots_query(user_id):
+    return (
+        db.select(Match.slot)
+        .join(Slot, Slot.id == Match.slot)
+        .where(Match.user == user_id)
+        .where(Match.confirmed == True)
+        .where(Match.cancel_time == None)
+        .order_by(Slot.start_time, Slot.id)
+    )
+
+
+def slot_events(slot_ids):
+    """VEVENTs of the confirmed groups of slots, built once per change."""
+    if not slot_ids:
+        return []
+    cache = get_config("CHATMATCH_FEED_CACHE")
+    events = dict(
+        zip(slot_ids, cache.get_many(*["vevent-%d" % slot_id for slot_id in slot_ids]))
+    )
+    missing = [slot_id for slot_id, event in events.items() if event is None]
+    if missing:
+        events.update(build_slot_events(missing))
+    return [events[slot_id] for slot_id in slot_ids if events.get(slot_id)]
+
+
+def build_slot_events(slot_ids):
+    """Render and cache the VEVENT of each slot's confirmed group.
+
+    Called whenever a group changes, so feeds only have to join strings.
+    """
+    slots = db.session.execute(
+        db.select(
+            Slot.id,
+            Slot.start_time,
+            Slot.duration,
+            Topic.topic,
+            # the group's last change, stable across rebuilds
+            func.max(func.coalesce(Match.edit_time, Match.create_time)),
+        )
+        .join(Topic, Topic.id == Slot.topic)
+        .join(Match, Match.slot == Slot.id)
+        .where(Slot.id.in_(slot_ids))
+        .group_by(Slot.id, Slot.start_time, Slot.duration, Topic.topic)
+    ).all()
+    groups = group_members(slot_ids)
+
+    events = dict()
+    for slot_id, start_time, duration, topic, changed in slots:
+        if slot_id not in groups:
+            continue
+        events[slot_id] = ics.event(
+            "slot-%d@chatmatch" % slot_id,
+            start_time,
+            duration,
+            topic,
+            changed,
+            location=get_config("CHATMATCH_LOCATION"),
+            description="Conversation with "
+            + ", ".join(nickname for user_id, nickname in groups[slot_id]),
+        )
+
+    cache = get_config("CHATMATCH_FEED_CACHE")
+    cache.delete_many(
+        *["vevent-%d" % slot_id for slot_id in slot_ids if slot_id not in events]
+    )
+    if events:
+        cache.set_many(
+            {"vevent-%d" % slot_id: event for slot_id, event in events.items()},
+            timeout=get_config("CHATMATCH_CACHE_TTL"),
+        )
+    return events
+
+
+def invalidate_calendars(user_ids):
+    if user_ids:
+        get_config("CHATMATCH_FEED_CACHE").delete_many(
+            *["ics-%d" % user_id for user_id in set(user_ids)]
+        )
+
+
+def external_url(endpoint, **values):
+    """Absolute URL for mails, which may be sent outside of a request."""
+    if get_config("CHATMATCH_URL"):
+        return get_config("CHATMATCH_URL").rstrip("/") + app.url_map.bind("").build(
+            endpoint, values
+        )
+    if has_request_context():
+        return url_for(endpoint, _external=True, **values)
+    return None
+
+
+def self_service_links(magic):
+    status_url = external_url("status", token=magic)
+    if status_url is None:
+        return ""
+    return """
+Your personal status page: %s
+Subscribe to your calendar: %s
+""" % (
+        status_url,
+        external_url("user_calendar", token=magic),
+    )
 
 
 def recalc_all_topics():
-    topics = db.session.execute(
-        db.select(Topic).where(Topic.hidden == False).order_by(Topic.id)
+    # "slot" checks every slot on its own, "global" assigns each user to at
+    # most one slot per topic, optimizing for the given objective
+    mode = request.args.get("mode", "slot")
+    objective = request.args.get("objective", "earliest")
+    if mode not in ("slot", "global") or objective not in OBJECTIVES:
+        return jsonify({"error": "unknown mode or objective"}), 400
+
+    if mode != "global":
+        objective = None
+
+    topic_ids = (
+        db.session.execute(
+            db.select(Topic.id).where(Topic.hidden == False).order_by(Topic.id)
+        )
+        .scalars()
+        .all()
     )
+
+    # long runs: queue one job per topic and let the client poll
+    if request.args.get("background"):
+        now = int(datetime.datetime.now().timestamp())
+        jobs = (
+            db.session.execute(
+                insert(Job).returning(Job.id, sort_by_parameter_order=True),
+                [
+                    {
+                        "kind": "recalc",
+                        "topic": topic_id,
+                        "objective": objective,
+                        "create_time": now,
+                    }
+                    for topic_id in topic_ids
+                ],
+            )
+            .scalars()
+            .all()
+            if topic_ids
+            else []
+        )
+        db.session.commit()
+        status = url_for("recalc_status", jobs=",".join(map(str, jobs)))
+        return jsonify({"jobs": jobs, "status": status}), 202, {"Location": status}
+
+    # one line per topic as soon as it is done
+    if request.args.get("format") == "ndjson":
+        return Response(
+            stream_with_context(stream_recalc(topic_ids, objective)),
+            mimetype="application/x-ndjson",
+        )
+
     results = dict()
-    for row in topics:
-        results[row.Topic.id] = recalc_topic(row.Topic.id)
+    for topic_id in topic_ids:
+        results[topic_id] = recalc_topic(topic_id, objective=objective)
 
     return jsonify(results)
 
 
-def recalc_topic(topic_id):
-    global db
+def stream_recalc(topic_ids, objective=None):
+    start = time.perf_counter()
+    for topic_id in topic_ids:
+        stats = dict()
+        topic_start = time.perf_counter()
+        ok = recalc_topic(topic_id, objective=objective, stats=stats)
+        stats["ms"] = round((time.perf_counter() - topic_start) * 1000, 1)
+        yield json.dumps(dict(topic=topic_id, ok=ok, **stats)) + "\n"
+    yield json.dumps(
+        {
+            "done": True,
+            "topics": len(topic_ids),
+            "ms": round((time.perf_counter() - start) * 1000, 1),
+        }
+    ) + "\n"
+
+
+def recalc_status():
+    try:
+        job_ids = [int(job_id) for job_id in request.args.get("jobs", "").split(",")]
+    except ValueError:
+        return jsonify({"error": "jobs must be comma separated job ids"}), 400
+
+    # without a matcher process, polling moves the work on, a topic at a time
+    if get_config("CHATMATCH_MATCHER") == "inline":
+        run_jobs(load_jobs(Job.id.in_(job_ids), Job.done_time == None, limit=1))
+
+    jobs = db.session.execute(
+        db.select(Job.id, Job.topic, Job.done_time, Job.error, Job.result)
+        .where(Job.id.in_(job_ids))
+        .order_by(Job.id)
+    ).all()
+    return jsonify(
+        {
+            "total": len(jobs),
+            "done": sum(1 for job in jobs if job.done_time),
+            "jobs": [
+                dict(
+                    id=job.id,
+                    topic=job.topic,
+                    done_time=job.done_time,
+                    error=job.error,
+                    **json.loads(job.result or "{}"),
+                )
+                for job in jobs
+            ],
+        }
+    )
+
 
-    print("✅ RECALC TOPIC %d" % topic_id)
+def recalc_topic(topic_id, slot_ids=None, objective=None, stats=None):
+    """Confirm seats of a topic, all slots or just slot_ids.
+
+    With an objective seats are assigned over all slots at once. If given,
+    stats counts the groups formed, mails queued and matches confirmed.
+    """
+    global db
+    if stats is None:
+        stats = dict()
+    for key in ("groups", "mails", "confirmed"):
+        stats.setdefault(key, 0)
+
+    if objective is not None:
+        print("✅ RECALC TOPIC %d - global, %s" % (topic_id, objective))
+    elif slot_ids is None:
+        print("✅ RECALC TOPIC %d" % topic_id)
+    else:
+        print("✅ RECALC TOPIC %d - %d slots" % (topic_id, len(slot_ids)))
 
     # try to load topic
     topics = db.session.execute(db.select(Topic).where(Topic.id == topic_id)).all()
@@ -493,75 +1268,268 @@ def recalc_topic(topic_id):
         return False
     topic = topics[0].Topic
 
-    # try to load slots
-    slots = db.session.execute(
-        db.select(Slot).where(Slot.topic == topics[0].Topic.id)
-    ).all()
-    if not len(slots):
+    with metrics.timer("matching"):
+        state = topic_state(topic)
+    if not len(state.slots):
         print("❎❎❎ RECALC TOPIC %d FAILURE - No slots found?" % topic_id)
         return False
-
-    # try to load matches
-    matches = db.session.execute(
-        db.select(Match, Slot)
-        .filter(Match.slot == Slot.id)
-        .filter(Slot.topic == topic_id)
-        .order_by(Match.slot, Slot.start_time, Match.create_time)
-    ).all()
-    if not len(matches):
+    if not len(state.match_slots):
         print("❎❎❎ RECALC TOPIC %d UNSUCCESSFUL - No matches found?" % topic_id)
         return False
-    else:
-        print("✅ RECALC TOPIC %d - %d matches" % (topic_id, len(matches)))
-
-        now = int(datetime.datetime.now().timestamp())
+    print("✅ RECALC TOPIC %d - %d matches" % (topic_id, len(state.match_slots)))
 
-        # collect matches by slot
-        matchslots = dict()
-        slot_id = None
-        for match, slot in matches:
-            # skip slots already past/started
-            if slot.start_time <= now:
-                continue
+    now = int(datetime.datetime.now().timestamp())
 
-            if slot_id != slot.id:
-                matchslots[slot.id] = []
-                slot_id = slot.id
-            if not match.cancel_time:
-                matchslots[slot.id].append(match)
-
-        # check whether we need to confirm
-        for slot_id in matchslots.keys():
-            if len(matchslots[slot_id]) >= topic.min_users:
-                confirm_previous = []
-                confirm_pending = []
-                for match in matchslots[slot_id]:
-                    if match.confirmed:
-                        confirm_previous.append(match.id)
-                    else:
-                        if (
-                            len(confirm_previous) + len(confirm_pending)
-                        ) < topic.max_users:
-                            print(
-                                "✅✅ RECALC TOPIC %d: Mail user %d about slot %d"
-                                % (topic_id, match.user, slot_id)
-                            )
-                            confirm_pending.append(match.id)
+    # check whether we need to confirm, without users already confirmed for
+    # another group at the same time
+    busy = fetch_busy(state.slots if slot_ids is None else slot_ids)
+    with metrics.timer("matching"):
+        if objective is not None:
+            groups = state.assign(now, objective, busy)
+        else:
+            groups = state.evaluate(now, slot_ids, busy)
+    for slot_id, group in groups.items():
+        # another worker may have handed out seats of this slot meanwhile
+        for attempt in range(get_config("CHATMATCH_LOCK_ATTEMPTS")):
+            if lock_slot(slot_id, len(group[0])):
+                break
+            print("❎ RECALC TOPIC %d: slot %d changed, retrying" % (topic_id, slot_id))
+            db.session.rollback()
+            topic_states.pop(topic_id, None)
+            state = topic_state(topic)
+            busy = fetch_busy(state.slots if objective is not None else [slot_id])
+            if objective is not None:
+                group = state.assign(now, objective, busy).get(slot_id)
+            else:
+                group = state.evaluate(now, [slot_id], busy).get(slot_id)
+            if group is None:
+                break
+        else:
+            print(
+                "❎❎❎ RECALC TOPIC %d: slot %d stays contended" % (topic_id, slot_id)
+            )
+            db.session.rollback()
+            continue
+        if group is None:
+            continue
+
+        confirm_previous, confirm_pending = group
+        slot = state.slots[slot_id]
+        for match_id in confirm_pending:
+            print(
+                "✅✅ RECALC TOPIC %d: Mail user %d about slot %d"
+                % (topic_id, slot.user_ids[slot.index(match_id)], slot_id)
+            )
 
-                send_slot_mail(slot, topic, confirm_previous, confirm_pending)
+        # commits the version bump together with the confirmations
+        confirmed = send_slot_mail(
+            slot_id, topic, confirm_previous, confirm_pending, now
+        )
+        if confirmed:
+            # the slot version was bumped with the confirmations
+            state.confirm(confirmed, now)
+            state.version += 1
+            # one mail per newly confirmed match
+            stats["groups"] += 1
+            stats["mails"] += len(confirmed)
+            stats["confirmed"] += len(confirmed)
 
     return True
 
 
-def send_topic_mail(user, topic):
+def lock_slot(slot_id, confirmed):
+    """Optimistically lock a slot before confirming more of its matches.
+
+    `confirmed` is the number of confirmed matches the caller based its
+    decision on. The slot version is bumped only if the database agrees and
+    nobody bumped it since, so concurrent workers can never hand out more
+    than max_users seats. The bump must be committed with the confirmations.
+    """
+    version, current = db.session.execute(slot_lock_query(slot_id)).one()
+    if current != confirmed:
+        return False
+
+    result = db.session.execute(
+        update(Slot)
+        .where(Slot.id == slot_id)
+        .where(Slot.version == version)
+        .values(version=Slot.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+
+def slot_lock_query(slot_id):
+    return db.select(
+        Slot.version,
+        db.select(func.count(Match.id))
+        .where(Match.slot == slot_id)
+        .where(Match.confirmed == True)
+        .where(Match.cancel_time == None)
+        .scalar_subquery(),
+    ).where(Slot.id == slot_id)
+
+
+def overlapping_query(user, slot_id, start_time, duration, confirmed=True):
+    """(match, slot, topic) of active matches of user, confirmed or waiting,
+    in slots other than slot_id that overlap start_time and duration, in any
+    topic."""
+    other = aliased(Match)
+    other_slot = aliased(Slot)
+    return (
+        db.select(other.id, other.slot, other_slot.topic)
+        .join(other_slot, other_slot.id == other.slot)
+        .where(other.user == user)
+        .where(other.slot != slot_id)
+        .where(other.confirmed == confirmed)
+        .where(other.cancel_time == None)
+        .where(other_slot.start_time < start_time + duration)
+        .where(start_time < other_slot.start_time + other_slot.duration)
+    )
+
+
+def freed_query(user_id, slot_ids):
+    """Waiting matches of user_id overlapping slot_ids, where the user gave up
+    confirmed seats."""
+    return (
+        overlapping_query(
+            user_id, Slot.id, Slot.start_time, Slot.duration, confirmed=False
+        )
+        .where(Slot.id.in_(slot_ids))
+        .distinct()
+    )
+
+
+def busy_query(slot_ids):
+    """(slot, user) of matches waiting in slot_ids whose user is already
+    confirmed for an overlapping slot."""
+    return (
+        db.select(Match.slot, Match.user)
+        .join(Slot, Slot.id == Match.slot)
+        .where(Match.slot.in_(slot_ids))
+        .where(Match.confirmed == False)
+        .where(Match.cancel_time == None)
+        .where(
+            overlapping_query(
+                Match.user, Match.slot, Slot.start_time, Slot.duration
+            ).exists()
+        )
+    )
+
+
+def fetch_busy(slot_ids):
+    busy = dict()
+    for slot_id, user_id in db.session.execute(busy_query(list(slot_ids))):
+        busy.setdefault(slot_id, set()).add(user_id)
+    return busy
+
+
+def topic_state(topic):
+    global topic_states
+
+    # catch the in-memory state up on the jobs written since, by this or any
+    # other process. Seats handed out elsewhere only show in the slot
+    # versions, those need a reload.
+    state = topic_states.get(topic.id)
+    if (
+        state is not None
+        and db.session.execute(topic_version_query(topic.id)).scalar_one()
+        == state.version
+    ):
+        try:
+            state.replay(load_jobs(Job.topic == topic.id, Job.id > state.job_id))
+        except KeyError:
+            # a slot or match unknown to the state
+            pass
+        else:
+            state.min_users = topic.min_users
+            state.max_users = topic.max_users
+            return state
+
+    print("✅ LOAD MATCHING STATE TOPIC %d" % topic.id)
+    # watermark first, changes after it only cause another reload
+    state = TopicState(
+        topic.id,
+        topic.min_users,
+        topic.max_users,
+        job_id=db.session.execute(last_job_query(topic.id)).scalar_one(),
+        version=db.session.execute(topic_version_query(topic.id)).scalar_one(),
+    )
+    slots = db.session.execute(topic_slots_query(topic.id))
+    for slot_id, start_time, duration in slots:
+        state.add_slot(slot_id, start_time, duration)
+
+    matches = db.session.execute(topic_matches_query(topic.id))
+    for (
+        match_id,
+        slot_id,
+        user_id,
+        create_time,
+        edit_time,
+        confirmed,
+        cancel,
+    ) in matches:
+        flags = (CONFIRMED if confirmed else 0) | (CANCELLED if cancel else 0)
+        state.add(slot_id, match_id, user_id, create_time, edit_time, flags)
+
+    topic_states[topic.id] = state
+    return state
+
+
+def topic_slots_query(topic_id):
+    return (
+        db.select(Slot.id, Slot.start_time, Slot.duration)
+        .where(Slot.topic == topic_id)
+        .order_by(Slot.start_time)
+    )
+
+
+def topic_matches_query(topic_id):
+    return (
+        db.select(
+            Match.id,
+            Match.slot,
+            Match.user,
+            Match.create_time,
+            Match.edit_time,
+            Match.confirmed,
+            Match.cancel_time,
+        )
+        .join(Slot, Match.slot == Slot.id)
+        .where(Slot.topic == topic_id)
+        .order_by(Match.create_time, Match.id)
+    )
+
+
+def last_job_query(topic_id):
+    return db.select(func.coalesce(func.max(Job.id), 0)).where(Job.topic == topic_id)
+
+
+def topic_version_query(topic_id):
+    return db.select(func.coalesce(func.sum(Slot.version), 0)).where(
+        Slot.topic == topic_id
+    )
+
+
+@metrics.timed("mail")
+def send_topic_mail(user, topics):
     global db
+    # one mail for everything picked in the submit
     slots = db.session.execute(
-        db.select(Match, Slot)
+        db.select(Slot.topic, Slot.start_time, Slot.duration)
         .filter(Match.slot == Slot.id)
         .filter(Match.user == user.id)
-        .filter(Slot.topic == topic.id)
-        .order_by(Match.slot, Slot.start_time, Match.create_time)
+        .filter(Match.cancel_time == None)
+        .filter(Slot.topic.in_([topic.id for topic in topics]))
+        .order_by(Slot.topic, Slot.start_time)
     ).all()
+    topic_slots = dict()
+    for topic_id, start_time, duration in slots:
+        start = datetime.datetime.fromtimestamp(start_time)
+        end = start + datetime.timedelta(seconds=duration)
+        topic_slots.setdefault(topic_id, []).append(
+            "%s-%s" % (start.strftime("%d.%m.%Y %H:%M"), end.strftime("%H:%M"))
+        )
 
     message = """To: %s <%s>
 From: Relationship Geeks Matching Service
@@ -569,27 +1537,26 @@ Subject: You've signed up for a conversation
 
 Hi Relationship Geek!
 
-You've signed up for a conversation about %s for the following time slots:
-
-""" % (user.nickname, user.email, '"' + topic.topic + '"')
+You've signed up for conversations about the following topics and time slots:
+""" % (user.nickname, user.email)
 
-    slot_id = None
-    for match, slot in slots:
-        if slot.id != slot_id:
-            slot_id = slot.id
-            start_time = datetime.datetime.fromtimestamp(slot.start_time)
-            end_time = start_time + datetime.timedelta(seconds=slot.duration)
-            if not match.cancel_time:
-                message += "%s-%s\n" % (
-                    start_time.strftime("%d.%m.%Y %H:%M"),
-                    end_time.strftime("%H:%M"),
-                )
+    for topic in topics:
+        message += """
+"%s" (groups of %d to %d people):
+%s""" % (
+            topic.topic,
+            topic.min_users,
+            topic.max_users,
+            "".join("%s\n" % slot for slot in topic_slots.get(topic.id, []))
+            or "(no time slots picked for this topic)\n",
+        )
 
     message += """
-As soon as at least %d (max %d) people have signed up for a conversation about this topic for one of the time above time slots we'll send you another message to confirm the conversation is happening!
+As soon as enough people have signed up for a conversation about one of these topics for one of the above time slots we'll send you another message to confirm the conversation is happening!
 
 If nobody signs up for the same topic & time slot you won't receive further messages.
-""" % (topic.min_users, topic.max_users)
+"""
+    message += self_service_links(user.magic)
 
     if app.debug:
         print("RECIPIENT")
@@ -598,37 +1565,77 @@ If nobody signs up for the same topic & time slot you won't receive further mess
         print(message)
         print("ENDMESSAGE")
     else:
-        send_mail(user.email, message)
+        queue_mail(user.email, message)
+        db.session.commit()
 
 
-def send_slot_mail(slot, topic, confirm_previous, confirm_pending):
+@metrics.timed("mail")
+def send_slot_mail(slot_id, topic, confirm_previous, confirm_pending, now=None):
     global db
-    users = db.session.execute(
-        db.select(User, Match)
-        .filter(Match.slot == slot.id)
-        .filter(User.id == Match.user)
-        .order_by(User.nickname)
+    # only the matches of the group, one query, without those cancelled since
+    # the matching state was built
+    rows = db.session.execute(
+        slot_group_query(slot_id, list(confirm_previous) + list(confirm_pending))
     ).all()
 
-    if not len(users):
-        print("❎❎❎ SLOT MAIL %d UNSUCCESSFUL - No users found?" % slot.id)
-        return False
+    if not len(rows):
+        print("❎❎❎ SLOT MAIL %d UNSUCCESSFUL - No users found?" % slot_id)
+        db.session.rollback()
+        return []
 
-    now = int(datetime.datetime.now().timestamp())
+    if now is None:
+        now = int(datetime.datetime.now().timestamp())
+
+    # confirm everybody still waiting at once, the UPDATE checks again so a
+    # concurrent cancellation wins and nobody is confirmed into two groups at
+    # the same time
+    pending = set(confirm_pending)
+    waiting = [row for row in rows if row.id in pending and not row.confirmed]
+    confirmed = []
+    if not app.debug and waiting:
+        # other topics' workers confirm the same users, queue up behind them
+        db.session.execute(
+            user_lock_query(sorted(row.user_id for row in waiting))
+        ).all()
+        confirmed = (
+            db.session.execute(
+                update(Match)
+                .where(Match.id.in_([row.id for row in waiting]))
+                .where(Match.confirmed == False)
+                .where(Match.cancel_time == None)
+                .where(
+                    ~overlapping_query(
+                        Match.user, slot_id, rows[0].start_time, rows[0].duration
+                    ).exists()
+                )
+                .values(confirmed=True, confirm_time=now, edit_time=now)
+                .returning(Match.id)
+                .execution_options(synchronize_session=False)
+            )
+            .scalars()
+            .all()
+        )
+    group = [
+        row
+        for row in rows
+        if row.confirmed or row.id in confirmed or (app.debug and row.id in pending)
+    ]
+    if len(group) < topic.min_users:
+        print(
+            "❎❎❎ SLOT MAIL %d UNSUCCESSFUL - Only %d users left?"
+            % (slot_id, len(group))
+        )
+        db.session.rollback()
+        return []
 
     # collect nicknames
-    nicknames = []
-    for user, match in users:
-        if match.id in confirm_previous or match.id in confirm_pending:
-            nicknames.append(user.nickname)
+    nicknames = [row.nickname for row in group]
     if app.debug:
+        import pprint
+
         print("NICKNAMES")
         pprint.pp(nicknames)
 
-    if not len(nicknames):
-        print("❎❎❎ SLOT MAIL %d UNSUCCESSFUL - Nicknames not collected?" % slot.id)
-        return False
-
     message = """From: Relationship Geeks Matching Service
 Subject: Conversation matched!
 
@@ -640,8 +1647,8 @@ You've signed up for a conversation about %s, and we've found matches!
 
     message += "Timeslot: "
 
-    start_time = datetime.datetime.fromtimestamp(slot.start_time)
-    end_time = start_time + datetime.timedelta(seconds=slot.duration)
+    start_time = datetime.datetime.fromtimestamp(rows[0].start_time)
+    end_time = start_time + datetime.timedelta(seconds=rows[0].duration)
     message += "%s-%s\n" % (
         start_time.strftime("%d.%m.%Y %H:%M"),
         end_time.strftime("%H:%M"),
@@ -657,28 +1664,62 @@ You will be meeting with the following list of people at the Relationship Geeks
 Have a lot of fun!
 """
 
-    for user, match in users:
-        if match.id in confirm_pending and not match.confirmed:
-            if app.debug:
-                print("RECIPIENT")
-                print(user.email)
-                print("STARTMESSAGE")
-                print(message)
-                print("ENDMESSAGE")
-            else:
-                message = ("To: %s <%s>\n" % (user.nickname, user.email)) + message
-                send_mail(user.email, message)
+    for row in rows:
+        if app.debug and row.id in pending and not row.confirmed:
+            print("RECIPIENT")
+            print(row.email)
+            print("STARTMESSAGE")
+            print(message)
+            print("ENDMESSAGE")
+        elif row.id in confirmed:
+            queue_mail(
+                row.email,
+                ("To: %s <%s>\n" % (row.nickname, row.email))
+                + message
+                + self_service_links(row.magic),
+            )
 
-                db.session.query(Match).filter(Match.id == match.id).update(
-                    {
-                        "confirmed": True,
-                        "confirm_time": now,
-                        "edit_time": now,
-                        "cancel_time": None,
-                    }
-                )
+    if not confirmed:
+        # nothing handed out, leave the slot version alone
+        db.session.rollback()
+        return []
     db.session.commit()
 
+    # the whole group shows up in every member's calendar
+    build_slot_events([slot_id])
+    invalidate_calendars([row.user_id for row in rows])
+    return confirmed
+
+
+def user_lock_query(user_ids):
+    return (
+        db.select(User.id)
+        .where(User.id.in_(user_ids))
+        .order_by(User.id)
+        .with_for_update()
+    )
+
+
+def slot_group_query(slot_id, match_ids):
+    return (
+        db.select(
+            Match.id,
+            Match.confirmed,
+            User.id.label("user_id"),
+            User.nickname,
+            User.email,
+            User.magic,
+            Slot.start_time,
+            Slot.duration,
+        )
+        .join(User, User.id == Match.user)
+        .join(Slot, Slot.id == Match.slot)
+        .where(Match.slot == slot_id)
+        .where(Match.id.in_(match_ids))
+        .where(Match.cancel_time == None)
+        .order_by(User.nickname)
+    )
+
 
 def register():
     form = UserForm()
@@ -771,123 +1812,111 @@ def calendar():
     # get topic argument from URL
     topic_id = request.args.get("topic", 1, type=int)
 
-    # fetch Matches for Slots
-    match_rows = db.session.execute(
-        db.select(Match).where(Match.slot == Slot.id, Slot.topic == topic_id)
+    slots = slot_occupancy(topic_id)
+    if not slots:
+        abort(404)
+    topic = slots[0]
+
+    titles, calendar = occupancy_calendar(
+        slots,
+        lambda slot: '<a href="%s">%d/%d, %d confirmed</a>'
+        % (
+            url_for("slot_form", slot_id=slot.id),
+            slot.matched - slot.cancelled,
+            slot.min_users,
+            slot.confirmed,
+        ),
     )
-    if app.debug and 0:
-        pprint.pp(topic_id)
-        pprint.pp(match_rows)
-
-    # prepare matches
-    matches = dict()
-    for row in match_rows:
-        if app.debug and 0:
-            pprint.pp(row)
-            pprint.pp(type(row.Match))
-            pprint.pp(row.Match.__dict__)
-        if row.Match.slot not in matches:
-            matches[row.Match.slot] = dict()
-            matches[row.Match.slot]["matched"] = 0
-            matches[row.Match.slot]["confirmed"] = 0
-            matches[row.Match.slot]["cancelled"] = 0
-        matches[row.Match.slot]["matched"] += 1
-        matches[row.Match.slot]["confirmed"] += 1 if row.Match.confirmed else 0
-        matches[row.Match.slot]["cancelled"] += 1 if row.Match.cancel_time else 0
-
-    if app.debug and 0:
-        pprint.pp(matches)
 
-    # fetch Slots and Topic
-    slot_rows = db.session.execute(
-        db.select(Slot, Topic).where(Slot.topic == Topic.id, Topic.id == topic_id)
+    # render calendar
+    return render_template(
+        "calendar.html",
+        titles=titles,
+        calendar=calendar,
+        topic_title=topic.topic,
+        topic_description=topic.description,
+        safe_columns=[day for day, title in titles[1:]],
     )
-    if app.debug and 0:
-        print(topic_id)
-        pprint.pp(slot_rows)
-
-    # collect data for calendar view
-    days = dict()
-    slots = dict()
-    topic = Topic()
-    for row in slot_rows:
-        if app.debug and 0:
-            pprint.pp(row)
-            pprint.pp(type(row.Slot))
-            pprint.pp(row.Slot.__dict__)
-            pprint.pp(type(row.Topic))
-            pprint.pp(row.Topic.__dict__)
-
-        # this will override the higher scope variable all of the time
-        topic = row.Topic
-
-        start_time = datetime.datetime.fromtimestamp(row.Slot.start_time)
-        end_time = start_time + datetime.timedelta(seconds=row.Slot.duration)
-        day = start_time.strftime("%Y%m%d")
 
-        if app.debug and 0:
-            pprint.pp(start_time)
-            pprint.pp(end_time)
-            pprint.pp(day)
 
-        if not day in days:
-            days[day] = dict()
-        slot = "%s-%s" % (start_time.strftime("%H:%M"), end_time.strftime("%H:%M"))
-        if slot not in slots:
-            slots[slot] = 0
-        else:
-            slots[slot] += 1
+def admin_occupancy():
+    slots = slot_occupancy()
+    topics = []
+    for slot in slots:
+        if not topics or topics[-1]["id"] != slot.topic_id:
+            topics.append(
+                {
+                    "id": slot.topic_id,
+                    "topic": slot.topic,
+                    "description": slot.description,
+                    "slots": [],
+                }
+            )
+        topics[-1]["slots"].append(slot)
 
-        # construct slot cell entry
-        matched = 0
-        confirmed = 0
-        cancelled = 0
-        if row.Slot.id in matches:
-            matched = matches[row.Slot.id]["matched"]
-            confirmed = matches[row.Slot.id]["confirmed"]
-            cancelled = matches[row.Slot.id]["cancelled"]
-
-        days[day][slot] = '<a href="%s">%d/%d, %d confirmed</a>' % (
-            url_for("slot_form", slot_id=row.Slot.id),
-            matched - cancelled,
-            topic.min_users,
-            confirmed,
+    for topic in topics:
+        topic["titles"], topic["calendar"] = occupancy_calendar(
+            topic["slots"],
+            lambda slot: "%d/%d, %d confirmed"
+            % (slot.matched - slot.cancelled, slot.min_users, slot.confirmed),
         )
-
-    # create headings
-    titles = [("slot", "Slot")]
-    safe_columns = []
-    for day in days.keys():
-        titles.append(
-            (day, datetime.datetime.strptime(day, "%Y%m%d").strftime("%d.%m.%Y"))
+    return render_template("occupancy.html", topics=topics)
+
+
+def slot_occupancy(topic_id=None):
+    """Matched, cancelled and confirmed counts of every slot of one or all
+    visible topics, counted by the database in one query."""
+    query = (
+        db.select(
+            Slot.id,
+            Slot.start_time,
+            Slot.duration,
+            Topic.id.label("topic_id"),
+            Topic.topic,
+            Topic.description,
+            Topic.min_users,
+            func.count(Match.id).label("matched"),
+            func.count(Match.cancel_time).label("cancelled"),
+            func.coalesce(func.sum(cast(Match.confirmed, Integer)), 0).label(
+                "confirmed"
+            ),
         )
-        safe_columns.append(day)
+        .join(Topic, Topic.id == Slot.topic)
+        .outerjoin(Match, Match.slot == Slot.id)
+        .group_by(Slot.id, Topic.id)
+        .order_by(Topic.id, Slot.start_time)
+    )
+    if topic_id is None:
+        query = query.where(Topic.hidden == False)
+    else:
+        query = query.where(Topic.id == topic_id)
+    return db.session.execute(query).all()
+
+
+@functools.lru_cache(maxsize=4096)
+def slot_label(start_time, duration):
+    """(day, day title, time of day) of a slot, all topics share these."""
+    start = datetime.datetime.fromtimestamp(start_time)
+    end = start + datetime.timedelta(seconds=duration)
+    return (
+        start.strftime("%Y%m%d"),
+        start.strftime("%d.%m.%Y"),
+        "%s-%s" % (start.strftime("%H:%M"), end.strftime("%H:%M")),
+    )
 
-    if app.debug and 0:
-        pprint.pp(titles)
-        pprint.pp(days)
 
-    # pivot data into calendar structure
-    calendar = []
-    for slot in dict(sorted(slots.items())):
-        entry = dict()
-        entry["slot"] = slot
-        for day, dayslots in days.items():
-            if slot in dayslots:
-                entry[day] = dayslots[slot]
-        if app.debug and 0:
-            pprint.pp(entry)
-        calendar.append(entry)
+def occupancy_calendar(slots, cell):
+    """Pivot slots into render_table() titles and rows: a row per time of
+    day, a column per day, cell(slot) in the cells."""
+    days = dict()
+    rows = dict()
+    for slot in slots:
+        day, title, label = slot_label(slot.start_time, slot.duration)
+        days[day] = title
+        rows.setdefault(label, {"slot": label})[day] = cell(slot)
 
-    # render calendar
-    return render_template(
-        "calendar.html",
-        titles=titles,
-        calendar=calendar,
-        topic_title=topic.topic,
-        topic_description=topic.description,
-        safe_columns=safe_columns,
-    )
+    titles = [("slot", "Slot")] + sorted(days.items())
+    return titles, [rows[label] for label in sorted(rows)]
 
 
 def admin():
@@ -902,25 +1931,664 @@ def favicon():
     return send_from_directory("static", "favicon.ico")
 
 
-def send_mail(recipient, message):
-    print("SENDING MAIL TO %s" % recipient)
-    context = ssl.create_default_context()
-    with smtplib.SMTP_SSL(
-        os.getenv("SMTP_SERVER", "localhost"),
-        int(os.getenv("SMTP_PORT", "465")),
-        context=context,
-    ) as server:
-        server.login(
+def get_smtp_pool():
+    global smtp_pool
+    # only the mail worker talks SMTP, so web workers never load smtplib/ssl
+    if smtp_pool is None:
+        from mailer import SMTPPool
+
+        smtp_pool = SMTPPool(
+            os.getenv("SMTP_SERVER", "localhost"),
+            int(os.getenv("SMTP_PORT", "465")),
             os.getenv("SMTP_USERNAME", "username@domain"),
             os.getenv("SMTP_PASSWORD", "password"),
+            size=int(os.getenv("SMTP_POOL_SIZE", "2")),
+            keepalive=int(os.getenv("SMTP_KEEPALIVE", "30")),
+        )
+    return smtp_pool
+
+
+@metrics.timed("mail")
+def send_mail(recipient, message):
+    from mailer import encode_message
+
+    print("SENDING MAIL TO %s" % recipient)
+    return get_smtp_pool().sendmail(recipient, encode_message(message))
+
+
+def queue_mail(recipient, message):
+    global db
+    print("✅ QUEUE MAIL TO %s" % recipient)
+    mail = Mail()
+    mail.recipient = recipient
+    mail.message = message
+    mail.create_time = int(datetime.datetime.now().timestamp())
+    mail.attempts = 0
+    db.session.add(mail)
+
+
+def mail_due(now):
+    return (
+        (Mail.send_time == None)
+        & (Mail.attempts < get_config("CHATMATCH_MAIL_ATTEMPTS"))
+        & ((Mail.retry_time == None) | (Mail.retry_time <= now))
+    )
+
+
+def due_mails_query(now):
+    return db.select(Mail.id, Mail.attempts).where(mail_due(now)).order_by(Mail.id)
+
+
+def claim_mail():
+    """Claim the oldest mail that is due, or return None.
+
+    The claim counts the attempt and moves retry_time past the backoff in
+    its own transaction, so other mail workers skip the mail while this one
+    sends it, and a worker crashing mid-send still uses up an attempt.
+    """
+    while True:
+        now = int(datetime.datetime.now().timestamp())
+        due = db.session.execute(due_mails_query(now).limit(1)).one_or_none()
+        if due is None:
+            return None
+        # only one worker's UPDATE still finds the mail due
+        claimed = db.session.execute(
+            update(Mail)
+            .where(Mail.id == due.id)
+            .where(Mail.attempts == due.attempts)
+            .where(mail_due(now))
+            .values(
+                attempts=due.attempts + 1,
+                # back off exponentially before the next attempt
+                retry_time=now + 60 * 2 ** (due.attempts + 1),
+            )
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            return db.session.get(Mail, due.id)
+
+
+def deliver_mails(limit=50):
+    global db
+    sent = 0
+    for count in range(limit):
+        mail = claim_mail()
+        if mail is None:
+            break
+        try:
+            send_mail(mail.recipient, mail.message)
+            mail.send_time = int(datetime.datetime.now().timestamp())
+            mail.error = None
+            sent += 1
+        except Exception as e:
+            # SMTP and network errors, but also anything else wrong with this
+            # one mail, which must not keep the rest of the outbox waiting
+            print("❎ SENDING MAIL %d TO %s FAILED: %s" % (mail.id, mail.recipient, e))
+            mail.error = str(e)
+        db.session.commit()
+
+    return sent
+
+
+@click.option("--once", is_flag=True, help="Deliver pending mails once and exit.")
+def mail_worker(once):
+    """Deliver mails queued in the mail outbox."""
+    print("✅ MAIL WORKER STARTED")
+    while True:
+        sent = deliver_mails()
+        if sent:
+            print("✅ MAIL WORKER SENT %d MAILS" % sent)
+        if once:
+            get_smtp_pool().close()
+            break
+        if not sent:
+            # keep pooled connections alive while the outbox is empty
+            get_smtp_pool().ping()
+            time.sleep(get_config("CHATMATCH_MAIL_INTERVAL"))
+
+
+# in-memory matching state per topic id
+topic_states = dict()
+
+# (nickname, email) -> user row of recent registrations, see load_user()
+recent_users = OrderedDict()
+
+# created on first use by get_smtp_pool()
+smtp_pool = None
+
+# set by create_app(), cleared after the first request was reported
+startup_time = None
+
+
+def time_first_request():
+    if startup_time is not None:
+        g.first_request_start = time.perf_counter()
+
+
+def report_first_request(response):
+    global startup_time
+    if startup_time is not None and "first_request_start" in g:
+        now = time.perf_counter()
+        print(
+            "✅ FIRST REQUEST took %.1fms, done %.1fms after startup"
+            % ((now - g.first_request_start) * 1000, (now - startup_time) * 1000)
+        )
+        startup_time = None
+    return response
+
+
+def collect_request_metrics():
+    g.request_start = time.perf_counter()
+    if get_config("CHATMATCH_METRICS"):
+        metrics.begin()
+    # profile a single request on demand
+    if get_config("CHATMATCH_PROFILE_DIR") and "profile" in request.args:
+        import cProfile
+
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def report_request_metrics(response):
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        path = os.path.join(
+            get_config("CHATMATCH_PROFILE_DIR"),
+            "%d-%s-%d.prof" % (int(time.time()), request.endpoint, os.getpid()),
+        )
+        profiler.dump_stats(path)
+        print("✅ PROFILE %s %s" % (request.path, path))
+        response.headers["X-Profile"] = os.path.basename(path)
+
+    record = metrics.end()
+    if record is None:
+        return response
+    endpoint = request.endpoint or "none"
+    metrics.request_seconds.observe(
+        time.perf_counter() - g.request_start,
+        endpoint=endpoint,
+        method=request.method,
+        status=response.status_code,
+    )
+    for kind in metrics.KINDS:
+        metrics.request_kind_seconds[kind].observe(record[kind], endpoint=endpoint)
+    metrics.request_queries.observe(record["queries"], endpoint=endpoint)
+    response.headers["Server-Timing"] = ", ".join(
+        "%s;dur=%.1f" % (kind, record[kind] * 1000) for kind in metrics.KINDS
+    )
+    return response
+
+
+def export_metrics():
+    return (
+        metrics.render(),
+        200,
+        {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+def hot_queries():
+    # the queries run on every registration, recalculation, calendar poll and
+    # mail delivery, built by the same helpers so they can't drift apart
+    now = int(datetime.datetime.now().timestamp())
+    return {
+        "slots of user": user_slots_query(1),
+        "slots of topic": topic_slots_query(1),
+        "matches of topic": topic_matches_query(1),
+        "last job of topic": last_job_query(1),
+        "new jobs of topic": jobs_query(Job.topic == 1, Job.id > 1),
+        "slot versions of topic": topic_version_query(1),
+        "pending jobs": jobs_query(
+            Job.done_time == None, limit=get_config("CHATMATCH_MATCHER_BATCH")
+        ),
+        "slot lock": slot_lock_query(1),
+        "group of slot": slot_group_query(1, [1, 2, 3]),
+        "users of group": user_lock_query([1, 2, 3]),
+        "busy users of slots": busy_query([1, 2, 3]),
+        "freed matches of user": freed_query(1, [1, 2, 3]),
+        "confirmed groups of slots": group_members_query([1, 2, 3]),
+        "user by token": user_by_token_query("token"),
+        "matches of user": user_matches_query(1),
+        "calendar of user": calendar_slots_query(1),
+        "due mails": due_mails_query(now).limit(1),
+    }
+
+
+def full_scans(plan, dialect):
+    if dialect == "sqlite":
+        # EXPLAIN QUERY PLAN rows are (id, parent, notused, detail)
+        return [
+            row[-1]
+            for row in plan
+            if row[-1].startswith("SCAN ") and "CONSTANT ROW" not in row[-1]
+        ]
+    return [row[0] for row in plan if "Seq Scan" in row[0]]
+
+
+@click.option(
+    "--create-indexes",
+    is_flag=True,
+    help="Create indexes missing from an existing database first.",
+)
+def explain_queries(create_indexes):
+    """EXPLAIN the hot queries and fail if one scans a whole table."""
+    dialect = db.engine.dialect.name
+    if create_indexes:
+        upgrade_database()
+
+    if dialect == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        prefix = "EXPLAIN "
+        # tiny tables make sequential scans look cheap, only accept them
+        # where no index could be used at all
+        db.session.execute(text("SET enable_seqscan = off"))
+
+    failed = 0
+    for name, query in hot_queries().items():
+        sql = str(query.compile(db.engine, compile_kwargs={"literal_binds": True}))
+        plan = db.session.execute(text(prefix + sql)).all()
+        scans = full_scans(plan, dialect)
+        if scans:
+            failed += 1
+            print("❎ %s: %s" % (name, "; ".join(scans)))
+        else:
+            print("✅ %s" % name)
+        if app.debug:
+            for row in plan:
+                print("    %s" % (row[-1] if dialect == "sqlite" else row[0]))
+    db.session.rollback()
+
+    if failed:
+        raise click.ClickException("%d queries scan whole tables" % failed)
+
+
+def upgrade_database():
+    """Add columns and indexes that db.create_all() skips on tables which
+    already exist. Safe to run any number of times."""
+    from sqlalchemy.schema import CreateColumn
+
+    inspector = inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in ChatMatch.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = set(
+                column["name"] for column in inspector.get_columns(table.name)
+            )
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                # new columns come with a server default or are nullable
+                print("✅ UPGRADE %s ADD COLUMN %s" % (table.name, column.name))
+                connection.execute(
+                    text(
+                        "ALTER TABLE %s ADD COLUMN %s"
+                        % (
+                            table.name,
+                            CreateColumn(column).compile(dialect=db.engine.dialect),
+                        )
+                    )
+                )
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+
+def insert_ignore(model):
+    # INSERT that silently skips rows violating a unique constraint
+    dialect = db.engine.dialect.name
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+        return sqlite_insert(model).on_conflict_do_nothing()
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+
+        return postgresql_insert(model).on_conflict_do_nothing()
+    if dialect in ("mysql", "mariadb"):
+        return insert(model).prefix_with("IGNORE")
+    return insert(model)
+
+
+def slot_times(schedule):
+    """Start timestamps of all slots of a schedule, in local time."""
+    duration = datetime.timedelta(seconds=schedule["duration"])
+    for day in schedule["days"]:
+        start = datetime.datetime.fromisoformat("%s %s" % (day["date"], day["start"]))
+        end = datetime.datetime.fromisoformat("%s %s" % (day["date"], day["end"]))
+        while start + duration <= end:
+            yield int(start.timestamp())
+            start += duration
+
+
+def seed_database(schedule=DEFAULT_SCHEDULE):
+    global db
+    now = int(datetime.datetime.now().timestamp())
+
+    # system user
+    db.session.execute(
+        insert_ignore(User).values(
+            email="system",
+            nickname="system",
+            magic=secrets.token_urlsafe(32),
+            create_time=now,
         )
-        return server.sendmail(
-            os.getenv("SMTP_USERNAME", "username@domain"), recipient, message
+    )
+    system = db.session.execute(
+        db.select(User.id).where(User.nickname == "system")
+    ).scalar_one()
+
+    # topics
+    topic_count = db.session.execute(db.select(func.count(Topic.id))).scalar_one()
+    rows = [
+        {
+            "topic": topic["topic"],
+            "description": topic.get("description"),
+            "hidden": topic.get("hidden", False),
+            "min_users": topic.get("min_users", 3),
+            "max_users": topic.get("max_users", 5),
+            "creator": system,
+            "create_time": now,
+        }
+        for topic in schedule.get("topics", DEFAULT_TOPICS)
+    ]
+    if rows:
+        db.session.execute(insert_ignore(Topic), rows)
+    topics = db.session.execute(db.select(func.count(Topic.id))).scalar_one()
+    query = db.select(Topic.id)
+    if "topics" in schedule:
+        # a schedule with its own topics leaves the other topics alone
+        query = query.where(
+            Topic.topic.in_([topic["topic"] for topic in schedule["topics"]])
         )
+    topic_ids = db.session.execute(query).scalars().all()
+
+    # slots for every topic of the schedule
+    slot_count = db.session.execute(db.select(func.count(Slot.id))).scalar_one()
+    rows = [
+        {
+            "topic": topic_id,
+            "start_time": start_time,
+            "duration": schedule["duration"],
+            "creator": system,
+            "create_time": now,
+        }
+        for topic_id in topic_ids
+        for start_time in slot_times(schedule)
+    ]
+    if rows:
+        db.session.execute(insert_ignore(Slot), rows)
+    db.session.commit()
+
+    topics -= topic_count
+    slots = db.session.execute(db.select(func.count(Slot.id))).scalar_one() - slot_count
+    if topics:
+        invalidate_topics()
+    if slots:
+        for topic_id in topic_ids:
+            invalidate_slots(topic_id)
+    print("✅ SEED %d TOPICS, %d SLOTS" % (topics, slots))
+    return topics, slots
+
+
+@click.option(
+    "--schedule",
+    type=click.File(),
+    help="JSON file with the event schedule (duration, days, topics).",
+)
+def seed(schedule):
+    """Create or upgrade tables and add the system user, topics and slots."""
+    db.create_all()
+    upgrade_database()
+    seed_database(json.load(schedule) if schedule else DEFAULT_SCHEDULE)
+
+
+def generate_database(
+    users=1000,
+    topics=10,
+    days=3,
+    slots_per_day=16,
+    density=0.2,
+    cancel_rate=0.1,
+    seed=None,
+):
+    """Fill the database with synthetic users, topics, slots and matches.
+
+    Every user picks each slot of each topic with probability density, and
+    cancels a pick again with probability cancel_rate. Nothing is confirmed,
+    run /recalc_all_topics afterwards for that.
+    """
+    global db
+    import random
+
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    now = int(datetime.datetime.now().timestamp())
+
+    # topics and slots of an event starting tomorrow, 08:00 onwards
+    first = datetime.date.today() + datetime.timedelta(days=1)
+    end = datetime.datetime(2000, 1, 1, 8) + datetime.timedelta(
+        minutes=30 * slots_per_day
+    )
+    names = ["Synthetic topic %d" % number for number in range(1, topics + 1)]
+    seed_database(
+        {
+            "duration": 1800,
+            "days": [
+                {
+                    "date": (first + datetime.timedelta(days=day)).isoformat(),
+                    "start": "08:00",
+                    "end": end.strftime("%H:%M"),
+                }
+                for day in range(days)
+            ],
+            "topics": [{"topic": name} for name in names],
+        }
+    )
+    slots = db.session.execute(
+        db.select(Slot.id, Slot.topic)
+        .join(Topic, Topic.id == Slot.topic)
+        .where(Topic.topic.in_(names))
+        .order_by(Slot.topic, Slot.start_time)
+    ).all()
+    topic_slots = dict()
+    for slot_id, topic_id in slots:
+        topic_slots.setdefault(topic_id, []).append(slot_id)
+
+    # users, numbered on from the existing ones so nicknames stay unique
+    offset = db.session.execute(db.select(func.max(User.id))).scalar() or 0
+    user_ids = (
+        db.session.execute(
+            insert(User).returning(User.id, sort_by_parameter_order=True),
+            [
+                {
+                    "email": "synthetic%d@example.org" % number,
+                    "nickname": "synthetic%d" % number,
+                    "magic": secrets.token_urlsafe(32),
+                    "create_time": now,
+                }
+                for number in range(offset + 1, offset + users + 1)
+            ],
+        )
+        .scalars()
+        .all()
+    )
+
+    # matches, registered during the past week
+    rows = []
+    for user_id in user_ids:
+        for slot_ids in topic_slots.values():
+            for slot_id in slot_ids:
+                if rng.random() >= density:
+                    continue
+                create_time = now - rng.randrange(7 * 86400)
+                cancel_time = None
+                if rng.random() < cancel_rate:
+                    cancel_time = rng.randint(create_time, now)
+                rows.append(
+                    {
+                        "slot": slot_id,
+                        "user": user_id,
+                        "create_time": create_time,
+                        "confirmed": False,
+                        "edit_time": cancel_time,
+                        "cancel_time": cancel_time,
+                    }
+                )
+    for chunk in range(0, len(rows), 10000):
+        db.session.execute(insert(Match), rows[chunk : chunk + 10000])
+    # done jobs, so matching states cached by running processes reload
+    if topic_slots:
+        db.session.execute(
+            insert(Job),
+            [
+                {
+                    "kind": "recalc",
+                    "topic": topic_id,
+                    "create_time": now,
+                    "done_time": now,
+                }
+                for topic_id in topic_slots
+            ],
+        )
+    db.session.commit()
+
+    print(
+        "✅ GENERATE %d USERS, %d SLOTS, %d MATCHES in %.1fs"
+        % (len(user_ids), len(slots), len(rows), time.perf_counter() - start)
+    )
+    return len(user_ids), len(slots), len(rows)
+
+
+@click.option("--users", type=click.IntRange(min=1), default=1000, show_default=True)
+@click.option("--topics", type=click.IntRange(min=1), default=10, show_default=True)
+@click.option(
+    "--days",
+    type=click.IntRange(min=1),
+    default=3,
+    show_default=True,
+    help="Starting tomorrow.",
+)
+@click.option(
+    "--slots-per-day",
+    type=click.IntRange(1, 31),
+    default=16,
+    show_default=True,
+    help="Half hour slots from 08:00.",
+)
+@click.option(
+    "--density",
+    type=click.FloatRange(0, 1),
+    default=0.2,
+    show_default=True,
+    help="Share of a topic's slots every user picks.",
+)
+@click.option(
+    "--cancel-rate",
+    type=click.FloatRange(0, 1),
+    default=0.1,
+    show_default=True,
+    help="Share of picks cancelled again.",
+)
+@click.option("--seed", type=int, help="Random seed, for reproducible data.")
+def generate(users, topics, days, slots_per_day, density, cancel_rate, seed):
+    """Fill the database with synthetic users, topics, slots and matches."""
+    db.create_all()
+    generate_database(users, topics, days, slots_per_day, density, cancel_rate, seed)
+
+
+def load_jobs(*criteria, limit=None):
+    # plain rows, so commits during recalculation don't expire them
+    return db.session.execute(jobs_query(*criteria, limit=limit)).all()
+
+
+def jobs_query(*criteria, limit=None):
+    return (
+        db.select(
+            Job.id,
+            Job.kind,
+            Job.objective,
+            Job.topic,
+            Job.slot,
+            Job.match,
+            Job.user,
+            Job.create_time,
+        )
+        .where(*criteria)
+        .order_by(Job.id)
+        .limit(limit)
+    )
+
+
+def run_jobs(jobs):
+    """Replay match change jobs on the matching state and recalculate the
+    slots they touched, topic by topic in job order."""
+    global db
+    topics = OrderedDict()
+    for job in jobs:
+        topics.setdefault(job.topic, []).append(job)
+
+    for topic_id, topic_jobs in topics.items():
+        # recalc_topic() replays the jobs on the matching state
+        slot_ids = set(job.slot for job in topic_jobs)
+        if None in slot_ids or any(job.kind == "recalc" for job in topic_jobs):
+            slot_ids = None
+        objective = None
+        for job in topic_jobs:
+            objective = job.objective or objective
+
+        error = None
+        stats = dict()
+        start = time.perf_counter()
+        try:
+            recalc_topic(topic_id, slot_ids, objective, stats)
+        except Exception as e:
+            # don't let one broken topic block the queue
+            db.session.rollback()
+            topic_states.pop(topic_id, None)
+            print("❎❎❎ JOBS TOPIC %d FAILED: %s" % (topic_id, e))
+            error = str(e)
+
+        db.session.execute(
+            update(Job)
+            .where(Job.id.in_([job.id for job in topic_jobs]))
+            .values(
+                done_time=int(datetime.datetime.now().timestamp()),
+                error=error,
+                result=json.dumps(
+                    dict(stats, ms=round((time.perf_counter() - start) * 1000, 1))
+                ),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+    return sum(len(topic_jobs) for topic_jobs in topics.values())
+
+
+@click.option("--once", is_flag=True, help="Process pending jobs once and exit.")
+def matcher(once):
+    """Apply pending matching jobs in order. Run exactly one of these."""
+    print("✅ MATCHER STARTED")
+    while True:
+        done = run_jobs(
+            load_jobs(
+                Job.done_time == None, limit=get_config("CHATMATCH_MATCHER_BATCH")
+            )
+        )
+        if done:
+            print("✅ MATCHER PROCESSED %d JOBS" % done)
+        if once:
+            break
+        if not done:
+            time.sleep(get_config("CHATMATCH_MATCHER_INTERVAL"))
 
 
 def create_app(test_config=None, debug=False):
-    global app, bootstrap, db, session
+    global app, bootstrap, db, session, startup_time
+    create_start = time.perf_counter()
     ## create and configure the app
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(
@@ -935,6 +2603,16 @@ def create_app(test_config=None, debug=False):
         SESSION_CACHELIB=FileSystemCache(
             threshold=500, cache_dir=os.getenv("SESSION_DIR", "sessions")
         ),
+        # shared by all workers on this host, so invalidation reaches them all
+        CHATMATCH_CACHE=FileSystemCache(
+            threshold=500, cache_dir=os.getenv("CACHE_DIR", "cache")
+        ),
+        # calendar feeds and events, one entry per user and slot: unbounded,
+        # pruning past a threshold reads every file on each write
+        CHATMATCH_FEED_CACHE=FileSystemCache(
+            threshold=0, cache_dir=os.getenv("FEED_CACHE_DIR", "feeds")
+        ),
+        CHATMATCH_CACHE_TTL=int(os.getenv("CHATMATCH_CACHE_TTL", "3600")),
         CHATMATCH_NAME=os.getenv("CHATMATCH_NAME", "ChatMatch"),
         CHATMATCH_SHORT_NAME=os.getenv(
             "CHATMATCH_SHORT_NAME", os.getenv("CHATMATCH_NAME", "ChatMatch")
@@ -942,6 +2620,23 @@ def create_app(test_config=None, debug=False):
         CHATMATCH_TITLE=os.getenv("CHATMATCH_TITLE", "ChatMatch"),
         CHATMATCH_THEME_COLOR=os.getenv("CHATMATCH_THEME_COLOR", "#ff5555"),
         CHATMATCH_BACKGROUND_COLOR=os.getenv("CHATMATCH_BACKGROUND_COLOR", "#5555ff"),
+        CHATMATCH_MAIL_ATTEMPTS=int(os.getenv("CHATMATCH_MAIL_ATTEMPTS", "5")),
+        CHATMATCH_MAIL_INTERVAL=float(os.getenv("CHATMATCH_MAIL_INTERVAL", "5")),
+        # "inline" runs matching in the request, "worker" leaves it to the
+        # single matcher process
+        CHATMATCH_MATCHER=os.getenv("CHATMATCH_MATCHER", "inline"),
+        CHATMATCH_MATCHER_BATCH=int(os.getenv("CHATMATCH_MATCHER_BATCH", "500")),
+        CHATMATCH_MATCHER_INTERVAL=float(os.getenv("CHATMATCH_MATCHER_INTERVAL", "1")),
+        CHATMATCH_LOCK_ATTEMPTS=int(os.getenv("CHATMATCH_LOCK_ATTEMPTS", "3")),
+        CHATMATCH_USER_CACHE=int(os.getenv("CHATMATCH_USER_CACHE", "1024")),
+        CHATMATCH_INIT_DB=os.getenv("CHATMATCH_INIT_DB", "1") not in ("", "0"),
+        # base URL for links in mails sent by the matcher or mail worker
+        CHATMATCH_URL=os.getenv("CHATMATCH_URL"),
+        CHATMATCH_LOCATION=os.getenv(
+            "CHATMATCH_LOCATION", "Relationship Geeks assembly"
+        ),
+        CHATMATCH_METRICS=bool(os.getenv("CHATMATCH_METRICS")),
+        CHATMATCH_PROFILE_DIR=os.getenv("CHATMATCH_PROFILE_DIR"),
     )
     app.config["CHATMATCH_DESCRIPTION"] = os.getenv(
         "CHATMATCH_DESCRIPTION",
@@ -959,6 +2654,8 @@ def create_app(test_config=None, debug=False):
       margin: 20px;
     }
 """
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     bootstrap = flask_bootstrap.Bootstrap5(app)
     db = SQLAlchemy(app, model_class=ChatMatch)
     app.jinja_env.globals.update(get_config=get_config, list_themes=list_themes)
@@ -967,6 +2664,9 @@ def create_app(test_config=None, debug=False):
 
     app.add_url_rule("/", "index", index, methods=["GET", "POST"])
     app.add_url_rule("/recalc_all_topics", "recalc_all_topics", recalc_all_topics)
+    app.add_url_rule("/recalc_all_topics/status", "recalc_status", recalc_status)
+    app.add_url_rule("/status/<token>", "status", status)
+    app.add_url_rule("/calendar/<token>.ics", "user_calendar", user_calendar)
     # app.add_url_rule("/register", "register", register, methods=["GET", "POST"])
     # app.add_url_rule("/table", "test_table", test_table)
     # app.add_url_rule("/table/<int:message_id>/view", "view_message", view_message)
@@ -978,152 +2678,29 @@ def create_app(test_config=None, debug=False):
     # app.add_url_rule("/topics", "topics", topics)
     # app.add_url_rule("/calendar", "calendar", calendar)
     app.add_url_rule("/admin", "admin", admin)
+    app.add_url_rule("/admin/occupancy", "admin_occupancy", admin_occupancy)
     app.add_url_rule("/site.webmanifest", "site_webmanifest", site_webmanifest)
     app.add_url_rule("/favicon.ico", "favicon", favicon)
-
-    with app.app_context():
-        # delete database contents
-        if bool(os.getenv("DANGER_DROP_DATABASE")):
-            db.drop_all()
-
-        # create database structures
-        try:
-            db.create_all()
-        except IntegrityError, PendingRollbackError:
-            pass
-
-        # system user
-        try:
-            user = User()
-            user.email = "system"
-            user.nickname = "system"
-            user.magic = base64.b64encode(os.urandom(32))
-            user.create_time = int(datetime.datetime.now().timestamp())
-            db.session.add(user)
-            db.session.commit()
-        except IntegrityError, PendingRollbackError:
-            db.session.rollback()
-            pass
-
-        # default topic (hideable)
-        try:
-            topic = Topic()
-            topic.topic = "Default"
-            topic.description = "This is the default topic. Usually not used."
-            topic.hidden = True
-            topic.min_users = 3
-            topic.max_users = 5
-            topic.creator = user.id
-            topic.create_time = int(datetime.datetime.now().timestamp())
-            db.session.add(topic)
-
-            topic = Topic()
-            topic.topic = "Poly with (planned) kids"
-            topic.hidden = False
-            topic.min_users = 3
-            topic.max_users = 5
-            topic.creator = user.id
-            topic.create_time = int(datetime.datetime.now().timestamp())
-            db.session.add(topic)
-
-            topic = Topic()
-            topic.topic = "Jealousy"
-            topic.hidden = False
-            topic.min_users = 3
-            topic.max_users = 5
-            topic.creator = user.id
-            topic.create_time = int(datetime.datetime.now().timestamp())
-            db.session.add(topic)
-
-            topic = Topic()
-            topic.topic = "Transitioning to Relationship Anarchy"
-            topic.hidden = False
-            topic.min_users = 3
-            topic.max_users = 5
-            topic.creator = user.id
-            topic.create_time = int(datetime.datetime.now().timestamp())
-            db.session.add(topic)
-
-            topic = Topic()
-            topic.topic = "Sex, safety and transparency"
-            topic.hidden = False
-            topic.min_users = 3
-            topic.max_users = 5
-            topic.creator = user.id
-            topic.create_time = int(datetime.datetime.now().timestamp())
-            db.session.add(topic)
-
-            topic = Topic()
-            topic.topic = "Organizing calendars and time limitations"
-            topic.hidden = False
-            topic.min_users = 3
-            topic.max_users = 5
-            topic.creator = user.id
-            topic.create_time = int(datetime.datetime.now().timestamp())
-            db.session.add(topic)
-
-            topic = Topic()
-            topic.topic = "Cohabitation"
-            topic.hidden = False
-            topic.min_users = 3
-            topic.max_users = 5
-            topic.creator = user.id
-            topic.create_time = int(datetime.datetime.now().timestamp())
-            db.session.add(topic)
-
-            db.session.commit()
-        except IntegrityError, PendingRollbackError:
-            db.session.rollback()
-            pass
-
-        # default slots (hardcoded for 39C3)
-        maxtopic = db.session.query(func.max(Topic.id)).all()[0][0]
-        for topic in range(1, maxtopic + 1):
+    app.cli.command("mail-worker")(mail_worker)
+    app.cli.command("explain-queries")(explain_queries)
+    app.cli.command("seed")(seed)
+    app.cli.command("generate")(generate)
+    app.cli.command("matcher")(matcher)
+
+    # schema work can be left to the seed command, so workers start quickly
+    if app.config["CHATMATCH_INIT_DB"]:
+        with app.app_context():
+            # delete database contents
+            if bool(os.getenv("DANGER_DROP_DATABASE")):
+                db.drop_all()
+
+            # create database structures
             try:
-                for day in range(27, 30 + 1):
-                    if day == 27:
-                        mintime = 13
-                        maxtime = 19
-                    elif day == 30:
-                        mintime = 11
-                        maxtime = 14
-                    else:
-                        mintime = 11
-                        maxtime = 18
-
-                    for time in range(mintime, maxtime + 1):
-                        # first half hour
-                        slot = Slot()
-                        slot.topic = topic
-                        slot.start_time = int(
-                            datetime.datetime(2025, 12, day, time, 0, 0).timestamp()
-                        )
-                        slot.duration = 1800
-                        slot.creator = user.id
-                        slot.create_time = int(datetime.datetime.now().timestamp())
-                        db.session.add(slot)
-
-                        # second half hour
-                        if not (day == 27 and time == 19):
-                            slot = Slot()
-                            slot.topic = topic
-                            slot.start_time = int(
-                                datetime.datetime(
-                                    2025, 12, day, time, 30, 0
-                                ).timestamp()
-                            )
-                            slot.duration = 1800
-                            slot.creator = user.id
-                            slot.create_time = int(datetime.datetime.now().timestamp())
-                            db.session.add(slot)
-                    db.session.commit()
+                db.create_all()
+                upgrade_database()
             except IntegrityError, PendingRollbackError:
-                db.session.rollback()
                 pass
 
-        #    - Day 1 (27.12.2025): Slots 1:00pm–7:30pm, selectable every 30 minutes
-        #    - Days 2/3 (28./29.12.): 11:00am–7:00pm, every 30 minutes
-        #    - Day 4 (30.12.2025): 11:00am–3:00pm, every 30 minutes
         # for i in range(20):
         #     url = 'mailto:x@t.me'
         #     if i % 7 == 0:
@@ -1150,10 +2727,32 @@ def create_app(test_config=None, debug=False):
         #     db.session.add(m)
         #     db.session.commit()
 
+    app.before_request(time_first_request)
+    app.after_request(report_first_request)
+
+    # opt-in instrumentation, see metrics.py
+    metrics.enabled = app.config["CHATMATCH_METRICS"]
+    if metrics.enabled:
+        metrics.install_sqlalchemy()
+        before_render_template.connect(metrics.before_render_template, app)
+        template_rendered.connect(metrics.template_rendered, app)
+        app.add_url_rule("/metrics", "metrics", export_metrics)
+    if app.config["CHATMATCH_PROFILE_DIR"]:
+        os.makedirs(app.config["CHATMATCH_PROFILE_DIR"], exist_ok=True)
+    if metrics.enabled or app.config["CHATMATCH_PROFILE_DIR"]:
+        app.before_request(collect_request_metrics)
+        app.after_request(report_request_metrics)
+    startup_time = time.perf_counter()
+    print(
+        "✅ STARTUP import %.1fms, create_app %.1fms"
+        % (IMPORT_TIME * 1000, (startup_time - create_start) * 1000)
+    )
     return app
 
 
 if __name__ == "__main__":
     global app
     app = create_app()
+    with app.app_context():
+        seed_database()
     app.run(debug=bool(os.getenv("DEBUG")))
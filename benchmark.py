@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Registration and matching benchmark.
+
+Simulates participants registering for all topics through the Flask test
+client against a fresh database, with an in-memory SMTP stand-in, and writes
+latency and wall time figures as JSON.
+"""
+
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import click
+import sqlalchemy
+
+
+class MemoryPool:
+    """Stands in for mailer.SMTPPool and keeps sent mails in memory."""
+
+    def __init__(self):
+        self.sent = []
+
+    def sendmail(self, recipient, message):
+        self.sent.append((recipient, message))
+        return {}
+
+    def ping(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def future_schedule(days, start="09:00", end="18:00", duration=1800):
+    """A schedule like app.DEFAULT_SCHEDULE, starting tomorrow."""
+    first = datetime.date.today() + datetime.timedelta(days=1)
+    return {
+        "duration": duration,
+        "days": [
+            {
+                "date": (first + datetime.timedelta(days=day)).isoformat(),
+                "start": start,
+                "end": end,
+            }
+            for day in range(days)
+        ],
+    }
+
+
+def choose_slots(rng, slotkeys):
+    """Pick slots the way people do: one or two days, and a block of
+    consecutive slots on each of them."""
+    days = dict()
+    for key in sorted(slotkeys):
+        # slots-<topic id>-YYYYmmdd-HH:MM-HH:MM
+        days.setdefault(key.split("-")[2], []).append(key)
+
+    chosen = []
+    for day in rng.sample(sorted(days), min(len(days), rng.choice((1, 1, 2)))):
+        keys = days[day]
+        length = min(len(keys), rng.randint(2, 6))
+        first = rng.randrange(len(keys) - length + 1)
+        chosen.extend(keys[first : first + length])
+    return chosen
+
+
+def summary(samples):
+    """Latency summary in milliseconds."""
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+    percentiles = (
+        statistics.quantiles(samples, n=100, method="inclusive")
+        if len(samples) > 1
+        else samples * 99
+    )
+    return {
+        "count": len(samples),
+        "mean": statistics.fmean(samples) * 1000,
+        "p50": percentiles[49] * 1000,
+        "p99": percentiles[98] * 1000,
+        "max": samples[-1] * 1000,
+    }
+
+
+def timed(samples, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    samples.append(time.perf_counter() - start)
+    return result
+
+
+@click.command()
+@click.option(
+    "--participants", default=200, show_default=True, help="Number of participants."
+)
+@click.option(
+    "--days", default=3, show_default=True, help="Event days, starting tomorrow."
+)
+@click.option(
+    "--database",
+    help="SQLAlchemy database URI. All its tables are dropped! "
+    "Defaults to a temporary SQLite file.",
+)
+@click.option(
+    "--matcher",
+    type=click.Choice(["inline", "worker"]),
+    default="inline",
+    show_default=True,
+    help="Match in the request, or afterwards like the matcher process.",
+)
+@click.option("--seed", default=1, show_default=True, help="Random seed.")
+@click.option(
+    "--output",
+    type=click.File("w"),
+    default="-",
+    help="Write the JSON results here (default stdout).",
+)
+@click.option("--verbose", is_flag=True, help="Keep the app's own output.")
+def benchmark(participants, days, database, matcher, seed, output, verbose):
+    """Register participants for all topics and time the hot paths."""
+    # the SQLite file and the caches go away with the directory
+    with contextlib.ExitStack() as stack:
+        workdir = stack.enter_context(
+            tempfile.TemporaryDirectory(prefix="chatmatch-benchmark-")
+        )
+        quiet = contextlib.nullcontext()
+        if not verbose:
+            quiet = contextlib.redirect_stdout(
+                stack.enter_context(open(os.devnull, "w"))
+            )
+        results = run_benchmark(
+            workdir, quiet, participants, days, database, matcher, seed
+        )
+
+    json.dump(results, output, indent=2)
+    output.write("\n")
+
+    # short human readable summary, stdout may carry the JSON
+    for name, values in results["latency_ms"].items():
+        print(
+            "%-20s p50 %8.2fms  p99 %8.2fms  (%d)"
+            % (name, values.get("p50", 0), values.get("p99", 0), values["count"]),
+            file=sys.stderr,
+        )
+    for name, value in results["wall_ms"].items():
+        print("%-20s %10.1fms" % (name, value), file=sys.stderr)
+
+
+def run_benchmark(workdir, quiet, participants, days, database, matcher, seed):
+    if database is None:
+        database = "sqlite:///%s" % os.path.join(workdir, "benchmark.sqlite3")
+
+    from cachelib.file import FileSystemCache
+
+    import app as chatmatch
+
+    with quiet:
+        application = chatmatch.create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": database,
+                "SQLALCHEMY_ECHO": False,
+                "TESTING": True,
+                "WTF_CSRF_ENABLED": False,
+                "SESSION_CACHELIB": FileSystemCache(
+                    threshold=participants * 2,
+                    cache_dir=os.path.join(workdir, "sessions"),
+                ),
+                "CHATMATCH_CACHE": FileSystemCache(
+                    threshold=500, cache_dir=os.path.join(workdir, "cache")
+                ),
+                "CHATMATCH_FEED_CACHE": FileSystemCache(
+                    threshold=0, cache_dir=os.path.join(workdir, "feeds")
+                ),
+                "CHATMATCH_MATCHER": matcher,
+                "CHATMATCH_INIT_DB": False,
+            }
+        )
+        chatmatch.smtp_pool = MemoryPool()
+        db = chatmatch.db
+        with application.app_context():
+            db.drop_all()
+            db.create_all()
+            chatmatch.seed_database(future_schedule(days))
+            topics = [topic_id for topic_id, name in chatmatch.fetch_topics()]
+            slotkeys = {
+                topic_id: sorted(chatmatch.fetch_slot_keys(topic_id)[0])
+                for topic_id in topics
+            }
+
+    rng = random.Random(seed)
+    samples = {"get_index": [], "post_index": []}
+    walls = dict()
+    start = time.perf_counter()
+    with quiet:
+        for number in range(participants):
+            client = application.test_client()
+            response = timed(samples["get_index"], client.get, "/")
+            assert response.status_code == 200, response.status_code
+            # one submit covers every topic, with slots picked per topic
+            data = {
+                "nickname": "participant%d" % number,
+                "email": "participant%d@example.org" % number,
+                "topic": [str(topic_id) for topic_id in topics],
+                "submit": "Submit",
+            }
+            for topic_id in topics:
+                for key in choose_slots(rng, slotkeys[topic_id]):
+                    data[key] = "y"
+            response = timed(samples["post_index"], client.post, "/", data=data)
+            assert response.status_code == 302, response.status_code
+    walls["register"] = time.perf_counter() - start
+
+    with quiet, application.app_context():
+        if matcher == "worker":
+            start = time.perf_counter()
+            chatmatch.run_jobs(chatmatch.load_jobs(chatmatch.Job.done_time == None))
+            walls["matcher"] = time.perf_counter() - start
+
+        # cold: state loaded from the database, warm: cached between requests
+        for state in ("cold", "warm"):
+            samples["recalc_topic_%s" % state] = []
+            for topic_id in topics:
+                if state == "cold":
+                    chatmatch.topic_states.pop(topic_id, None)
+                timed(
+                    samples["recalc_topic_%s" % state],
+                    chatmatch.recalc_topic,
+                    topic_id,
+                )
+
+        client = application.test_client()
+        for mode in ("slot", "global"):
+            chatmatch.topic_states.clear()
+            start = time.perf_counter()
+            response = client.get("/recalc_all_topics?mode=%s" % mode)
+            walls["recalc_all_topics_%s" % mode] = time.perf_counter() - start
+            assert response.status_code == 200, response.status_code
+
+        start = time.perf_counter()
+        while chatmatch.deliver_mails(limit=500):
+            pass
+        walls["deliver_mails"] = time.perf_counter() - start
+
+        counts = {
+            "users": db.session.execute(
+                db.select(sqlalchemy.func.count(chatmatch.User.id))
+            ).scalar_one(),
+            "slots": db.session.execute(
+                db.select(sqlalchemy.func.count(chatmatch.Slot.id))
+            ).scalar_one(),
+            "matches": db.session.execute(
+                db.select(sqlalchemy.func.count(chatmatch.Match.id))
+            ).scalar_one(),
+            "confirmed": db.session.execute(
+                db.select(sqlalchemy.func.count(chatmatch.Match.id)).where(
+                    chatmatch.Match.confirmed == True
+                )
+            ).scalar_one(),
+            "mails": len(chatmatch.smtp_pool.sent),
+        }
+        dialect = db.engine.dialect.name
+        db.engine.dispose()
+
+    return {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "environment": {
+            "python": platform.python_version(),
+            "sqlalchemy": sqlalchemy.__version__,
+            "database": dialect,
+        },
+        "config": {
+            "participants": participants,
+            "topics": len(topics),
+            "days": days,
+            "matcher": matcher,
+            "seed": seed,
+        },
+        "counts": counts,
+        "latency_ms": {name: summary(values) for name, values in samples.items()},
+        "wall_ms": {name: value * 1000 for name, value in walls.items()},
+    }
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+from zoneinfo import ZoneInfo
+
+TIMEZONE = "Europe/Berlin"
+
+# current EU rules, enough for clients that don't know the TZID
+VTIMEZONE = (
+    "BEGIN:VTIMEZONE",
+    "TZID:Europe/Berlin",
+    "BEGIN:DAYLIGHT",
+    "TZOFFSETFROM:+0100",
+    "TZOFFSETTO:+0200",
+    "TZNAME:CEST",
+    "DTSTART:19700329T020000",
+    "RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=-1SU",
+    "END:DAYLIGHT",
+    "BEGIN:STANDARD",
+    "TZOFFSETFROM:+0200",
+    "TZOFFSETTO:+0100",
+    "TZNAME:CET",
+    "DTSTART:19701025T030000",
+    "RRULE:FREQ=YEARLY;BYMONTH=10;BYDAY=-1SU",
+    "END:STANDARD",
+    "END:VTIMEZONE",
+)
+
+
+def escape(text):
+    return (
+        text.replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\n", "\\n")
+    )
+
+
+def fold(line):
+    """Fold a content line at 75 octets, as RFC 5545 asks."""
+    if len(line.encode()) <= 75:
+        return line
+    parts = []
+    part = ""
+    size = 0
+    for char in line:
+        length = len(char.encode())
+        if size + length > (75 if not parts else 74):
+            parts.append(part)
+            part = ""
+            size = 0
+        part += char
+        size += length
+    parts.append(part)
+    return "\r\n ".join(parts)
+
+
+def local_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, ZoneInfo(TIMEZONE)).strftime(
+        "%Y%m%dT%H%M%S"
+    )
+
+
+def utc_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.UTC).strftime(
+        "%Y%m%dT%H%M%SZ"
+    )
+
+
+def event(uid, start_time, duration, summary, stamp, location=None, description=None):
+    """One VEVENT, as CRLF terminated lines."""
+    lines = [
+        "BEGIN:VEVENT",
+        "UID:%s" % uid,
+        "DTSTAMP:%s" % utc_time(stamp),
+        "DTSTART;TZID=%s:%s" % (TIMEZONE, local_time(start_time)),
+        "DTEND;TZID=%s:%s" % (TIMEZONE, local_time(start_time + duration)),
+        "SUMMARY:%s" % escape(summary),
+    ]
+    if location:
+        lines.append("LOCATION:%s" % escape(location))
+    if description:
+        lines.append("DESCRIPTION:%s" % escape(description))
+    lines.append("END:VEVENT")
+    return "".join(fold(line) + "\r\n" for line in lines)
+
+
+def calendar(events, name=None):
+    """A VCALENDAR around already rendered VEVENTs."""
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//chatmatch//EN",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+    ]
+    if name:
+        lines.append("X-WR-CALNAME:%s" % escape(name))
+    lines.append("X-WR-TIMEZONE:%s" % TIMEZONE)
+    lines.extend(VTIMEZONE)
+    head = "".join(fold(line) + "\r\n" for line in lines)
+    return head + "".join(events) + "END:VCALENDAR\r\n"
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import smtplib
+import ssl
+import threading
+import time
+from email import policy
+from email.message import EmailMessage
+
+
+class SMTPPool:
+    """A small pool of authenticated SMTP connections.
+
+    Connections are handed out LIFO so the most recently used (and therefore
+    most likely still alive) one is reused first. Idle connections are checked
+    with NOOP before reuse, and broken ones are replaced transparently.
+    """
+
+    def __init__(
+        self, host, port, username, password, size=2, keepalive=30, timeout=30
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.context = ssl.create_default_context()
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def connect(self):
+        print("✅ SMTP CONNECT %s:%d" % (self.host, self.port))
+        server = smtplib.SMTP_SSL(
+            self.host, self.port, context=self.context, timeout=self.timeout
+        )
+        try:
+            server.login(self.username, self.password)
+        except BaseException:
+            discard(server)
+            raise
+        return server
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    server, last_used = self.idle.pop()
+                if time.monotonic() - last_used < self.keepalive or healthy(server):
+                    return server
+                print("❎ SMTP CONNECTION STALE, RECONNECTING")
+                discard(server)
+            return self.connect()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, server, broken=False):
+        if broken:
+            discard(server)
+        else:
+            with self.lock:
+                self.idle.append((server, time.monotonic()))
+        self.slots.release()
+
+    def sendmail(self, recipient, message):
+        # retry once on a fresh connection if the pooled one went away
+        for attempt in range(2):
+            server = self.acquire()
+            # unless the server answered, the connection's state is unknown
+            broken = True
+            try:
+                result = server.sendmail(self.username, recipient, message)
+                broken = False
+                return result
+            except smtplib.SMTPServerDisconnected:
+                if attempt:
+                    raise
+            except smtplib.SMTPException:
+                # recipient or message was refused, the connection is fine
+                broken = False
+                raise
+            except OSError:
+                if attempt:
+                    raise
+            finally:
+                self.release(server, broken=broken)
+
+    def ping(self):
+        """Send NOOP on idle connections so the server doesn't drop them."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for server, last_used in idle:
+            if healthy(server):
+                with self.lock:
+                    self.idle.append((server, time.monotonic()))
+            else:
+                discard(server)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for server, last_used in idle:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                discard(server)
+
+
+def encode_message(text):
+    """Turn a queued mail, headers and body in one str, into MIME bytes.
+
+    smtplib sends str messages as ASCII, so nicknames like "Jörg" would
+    fail. Headers get RFC 2047 encoded and the body is UTF-8.
+    """
+    head, _, body = text.partition("\n\n")
+    message = EmailMessage(policy=policy.SMTP)
+    for line in head.splitlines():
+        name, _, value = line.partition(":")
+        message[name.strip()] = value.strip()
+    message.set_content(body, cte="quoted-printable")
+    return message.as_bytes()
+
+
+def healthy(server):
+    try:
+        return server.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+        return False
+
+
+def discard(server):
+    try:
+        server.close()
+    except OSError:
+        pass
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+from array import array
+from bisect import bisect_right
+
+CONFIRMED = 1
+CANCELLED = 2
+
+OBJECTIVES = ("earliest", "fullest")
+
+
+class SlotState:
+    """Occupancy of one slot: parallel arrays of its matches in first come,
+    first served order (create_time, then match id)."""
+
+    __slots__ = (
+        "id",
+        "start_time",
+        "duration",
+        "match_ids",
+        "user_ids",
+        "create_times",
+        "edit_times",
+        "flags",
+    )
+
+    def __init__(self, slot_id, start_time, duration):
+        self.id = slot_id
+        self.start_time = start_time
+        self.duration = duration
+        self.match_ids = array("q")
+        self.user_ids = array("q")
+        self.create_times = array("q")
+        self.edit_times = array("q")
+        self.flags = array("b")
+
+    def __len__(self):
+        return len(self.match_ids)
+
+    def index(self, match_id):
+        return self.match_ids.index(match_id)
+
+    def add(self, match_id, user_id, create_time, edit_time=None, flags=0):
+        # matches almost always arrive in order, so this is usually an append
+        pos = len(self.match_ids)
+        if pos and (self.create_times[-1], self.match_ids[-1]) > (
+            create_time,
+            match_id,
+        ):
+            pos = bisect_right(
+                [(t, m) for t, m in zip(self.create_times, self.match_ids)],
+                (create_time, match_id),
+            )
+        self.match_ids.insert(pos, match_id)
+        self.user_ids.insert(pos, user_id)
+        self.create_times.insert(pos, create_time)
+        self.edit_times.insert(pos, create_time if edit_time is None else edit_time)
+        self.flags.insert(pos, flags)
+
+    def set_flags(self, match_id, flags, edit_time):
+        idx = self.index(match_id)
+        self.flags[idx] = flags
+        self.edit_times[idx] = edit_time
+
+    def evaluate(self, min_users, max_users, busy=()):
+        """Return (confirm_previous, confirm_pending) match ids for this slot.
+
+        A group exists once min_users matches are active. Already confirmed
+        matches keep their seats, the remaining seats up to max_users go to
+        unconfirmed matches in first come, first served order. Users in busy
+        are confirmed elsewhere at the same time and left out.
+        """
+        confirm_previous = []
+        waiting = []
+        for match_id, user_id, flags in zip(self.match_ids, self.user_ids, self.flags):
+            if flags & CANCELLED:
+                continue
+            if flags & CONFIRMED:
+                confirm_previous.append(match_id)
+            elif user_id not in busy:
+                waiting.append(match_id)
+        if len(confirm_previous) + len(waiting) < min_users:
+            return [], []
+
+        seats = max(max_users - len(confirm_previous), 0)
+        return confirm_previous, waiting[:seats]
+
+
+class TopicState:
+    """Occupancy of all slots of one topic, kept in memory between requests."""
+
+    __slots__ = (
+        "id",
+        "min_users",
+        "max_users",
+        "slots",
+        "match_slots",
+        "job_id",
+        "version",
+    )
+
+    def __init__(self, topic_id, min_users, max_users, job_id=0, version=0):
+        self.id = topic_id
+        self.min_users = min_users
+        self.max_users = max_users
+        self.slots = dict()
+        self.match_slots = dict()
+        # watermark of what the state reflects: every job of the topic up to
+        # job_id, and slot versions summing up to version (each hand-out of
+        # seats bumps one)
+        self.job_id = job_id
+        self.version = version
+
+    def add_slot(self, slot_id, start_time, duration):
+        self.slots[slot_id] = SlotState(slot_id, start_time, duration)
+
+    def slot_of(self, match_id):
+        return self.slots[self.match_slots[match_id]]
+
+    def add(self, slot_id, match_id, user_id, create_time, edit_time=None, flags=0):
+        self.slots[slot_id].add(match_id, user_id, create_time, edit_time, flags)
+        self.match_slots[match_id] = slot_id
+
+    def cancel(self, match_id, edit_time):
+        self.slot_of(match_id).set_flags(match_id, CANCELLED, edit_time)
+
+    def uncancel(self, match_id, edit_time):
+        self.slot_of(match_id).set_flags(match_id, 0, edit_time)
+
+    def confirm(self, match_ids, edit_time):
+        for match_id in match_ids:
+            self.slot_of(match_id).set_flags(match_id, CONFIRMED, edit_time)
+
+    def evaluate(self, now, slot_ids=None, busy=None):
+        """Return {slot_id: (confirm_previous, confirm_pending)} for every
+        future slot that has seats to hand out.
+
+        busy maps slot ids to the users confirmed elsewhere at that time.
+        """
+        if slot_ids is None:
+            slot_ids = self.slots.keys()
+        if busy is None:
+            busy = dict()
+
+        groups = dict()
+        for slot_id in slot_ids:
+            slot = self.slots.get(slot_id)
+            # skip unknown and already past/started slots
+            if slot is None or slot.start_time <= now:
+                continue
+            confirm_previous, confirm_pending = slot.evaluate(
+                self.min_users, self.max_users, busy.get(slot_id, ())
+            )
+            if confirm_pending:
+                groups[slot_id] = (confirm_previous, confirm_pending)
+        return groups
+
+    def assign(self, now, objective="earliest", busy=None):
+        """Solve seat assignment over all slots of the topic together.
+
+        Unlike evaluate(), every user ends up in at most one group: users
+        already confirmed somewhere keep that seat, everybody else is placed
+        greedily. With the "earliest" objective slots are filled in start
+        time order, as the spec asks; "fullest" always fills the slot with
+        the most available users next, favouring popular slots over early
+        ones. Takes and returns the same mappings as evaluate().
+        """
+        if objective not in OBJECTIVES:
+            raise ValueError("unknown objective %r" % objective)
+        if busy is None:
+            busy = dict()
+
+        # users holding a confirmed seat are not available elsewhere
+        assigned = set()
+        for slot in self.slots.values():
+            for user_id, flags in zip(slot.user_ids, slot.flags):
+                if flags == CONFIRMED:
+                    assigned.add(user_id)
+
+        open_slots = sorted(
+            (slot for slot in self.slots.values() if slot.start_time > now),
+            key=lambda slot: (slot.start_time, slot.id),
+        )
+
+        groups = dict()
+        while open_slots:
+            if objective == "earliest":
+                slot = open_slots.pop(0)
+            else:
+                best = max(
+                    range(len(open_slots)),
+                    key=lambda idx: (
+                        len(
+                            available(
+                                open_slots[idx],
+                                assigned,
+                                busy.get(open_slots[idx].id, ()),
+                            )
+                        ),
+                        -idx,
+                    ),
+                )
+                slot = open_slots.pop(best)
+
+            confirm_previous = [
+                match_id
+                for match_id, flags in zip(slot.match_ids, slot.flags)
+                if flags == CONFIRMED
+            ]
+            candidates = available(slot, assigned, busy.get(slot.id, ()))
+            if len(confirm_previous) + len(candidates) < self.min_users:
+                continue
+
+            seats = max(self.max_users - len(confirm_previous), 0)
+            confirm_pending = [match_id for match_id, user_id in candidates[:seats]]
+            if not confirm_pending:
+                continue
+            assigned.update(user_id for match_id, user_id in candidates[:seats])
+            groups[slot.id] = (confirm_previous, confirm_pending)
+
+        return groups
+
+    def replay(self, jobs):
+        """Apply the match changes recorded by jobs after job_id, in job
+        order, and move job_id on.
+
+        Raises KeyError for slots or matches the state doesn't know, the
+        state has to be loaded again then.
+        """
+        for job in jobs:
+            if job.id <= self.job_id:
+                continue
+            if job.kind == "add" and job.match not in self.match_slots:
+                self.add(job.slot, job.match, job.user, job.create_time)
+            elif job.kind == "uncancel":
+                self.uncancel(job.match, job.create_time)
+            elif job.kind == "cancel":
+                self.cancel(job.match, job.create_time)
+            self.job_id = job.id
+
+
+def available(slot, assigned, busy=()):
+    """(match_id, user_id) of active, unconfirmed matches of users that are
+    neither assigned yet nor busy, in first come, first served order."""
+    return [
+        (match_id, user_id)
+        for match_id, user_id, flags in zip(slot.match_ids, slot.user_ids, slot.flags)
+        if not flags and user_id not in assigned and user_id not in busy
+    ]
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# off unless the app opts in, timers are then almost free
+enabled = False
+
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNTS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# what a request spends its time on, db time overlaps with the others
+KINDS = ("db", "template", "matching", "mail")
+
+registry = []
+local = threading.local()
+
+
+class Histogram:
+    """Prometheus histogram with labels, kept in memory per process."""
+
+    def __init__(self, name, help, buckets=SECONDS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = dict()
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0, 0.0]
+            idx = bisect_left(self.buckets, value)
+            if idx < len(self.buckets):
+                series[0][idx] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s histogram" % self.name,
+        ]
+        with self.lock:
+            series = sorted(
+                (key, [list(b), c, s]) for key, (b, c, s) in self.series.items()
+            )
+        for key, (buckets, count, total) in series:
+            cumulative = 0
+            for bound, hits in zip(self.buckets, buckets):
+                cumulative += hits
+                lines.append(
+                    "%s_bucket%s %d"
+                    % (
+                        self.name,
+                        format_labels(key + (("le", str(bound)),)),
+                        cumulative,
+                    )
+                )
+            lines.append(
+                "%s_bucket%s %d"
+                % (self.name, format_labels(key + (("le", "+Inf"),)), count)
+            )
+            lines.append("%s_sum%s %r" % (self.name, format_labels(key), total))
+            lines.append("%s_count%s %d" % (self.name, format_labels(key), count))
+        return "\n".join(lines)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"'
+        % (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in labels
+    )
+
+
+def render():
+    """All metrics in Prometheus text format."""
+    return "\n".join(histogram.render() for histogram in registry) + "\n"
+
+
+request_seconds = Histogram("chatmatch_request_seconds", "Request duration.")
+request_kind_seconds = {
+    kind: Histogram(
+        "chatmatch_request_%s_seconds" % kind, "Time a request spent on %s." % kind
+    )
+    for kind in KINDS
+}
+request_queries = Histogram(
+    "chatmatch_request_queries", "Database queries per request.", COUNTS
+)
+
+
+def begin():
+    """Start collecting timings for the current request."""
+    local.record = dict.fromkeys(KINDS, 0.0)
+    local.record["queries"] = 0
+    return local.record
+
+
+def end():
+    record = getattr(local, "record", None)
+    local.record = None
+    return record
+
+
+def add(kind, seconds):
+    record = getattr(local, "record", None)
+    if record is not None:
+        record[kind] += seconds
+
+
+@contextmanager
+def timer(kind):
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(kind, time.perf_counter() - start)
+
+
+def timed(kind):
+    """Decorator version of timer()."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(kind):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info["metrics_start"].pop()
+    record = getattr(local, "record", None)
+    if record is not None:
+        record["db"] += time.perf_counter() - start
+        record["queries"] += 1
+
+
+def install_sqlalchemy():
+    """Time every statement of every engine."""
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+
+def before_render_template(sender, **extra):
+    local.template_start = time.perf_counter()
+
+
+def template_rendered(sender, **extra):
+    start = getattr(local, "template_start", None)
+    if start is not None:
+        add("template", time.perf_counter() - start)
+        local.template_start = None